@@ -0,0 +1,289 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import usmap
+from data_agg import create_flow_bundle
+from sparse_flows import SparseFlows, compress_pairs
+
+STATE_FUNCTIONS = (usmap.migration_data, usmap.race_data, usmap.miles_moved_race, usmap.miles_moved_race_q)
+RACES = ['Asian', 'Black', 'Hispanic', 'Other', 'White']
+
+
+def synthetic_flows(scale, seed=0):
+    """
+    Method that builds a random FlowTensor about scale times the size of the real data.
+    Up to 10x the extra size goes to more geographic units, beyond that the groups are
+    also multiplied, as if several cohorts were stacked on the race axis
+    :param scale: size relative to 51 states x 5 races x 5 quintiles
+    :param seed: random seed
+    :return: FlowTensor
+    """
+    rng = np.random.default_rng(seed)
+    cohorts = max(1, int(round(scale / 10)))
+    n_units = int(round(51 * np.sqrt(scale / cohorts)))
+
+    states = np.array(['Unit {:04d}'.format(i) for i in range(n_units)], dtype=object)
+    races = np.array(['{} {}'.format(race, cohort) if cohorts > 1 else race
+                      for cohort in range(1, cohorts + 1) for race in RACES], dtype=object)
+    quintiles = np.arange(1, 6)
+    flows = rng.integers(0, 1000, size=(n_units, n_units, len(races), len(quintiles)), dtype=np.int64)
+    lat_lon = np.column_stack([rng.uniform(25, 49, n_units), rng.uniform(-124, -67, n_units)])
+
+    return usmap.FlowTensor(flows, states, np.arange(1, n_units + 1), races, quintiles, lat_lon)
+
+
+def synthetic_sparse_flows(n_units, destinations=300, seed=0):
+    """
+    Method that builds random SparseFlows at county scale, where every unit sends people
+    to a few hundred of the others
+    :param n_units: number of geographic units
+    :param destinations: number of destinations drawn per origin
+    :param seed: random seed
+    :return: SparseFlows
+    """
+    rng = np.random.default_rng(seed)
+    o_codes = np.repeat(np.arange(n_units), destinations)
+    d_codes = rng.integers(0, n_units, len(o_codes))
+    indptr, indices, pair_codes = compress_pairs(o_codes, d_codes, n_units)
+    counts = np.zeros((len(indices), len(RACES), 5), dtype=np.int64)
+    np.add.at(counts, pair_codes, rng.integers(0, 100, (len(o_codes), len(RACES), 5)))
+
+    states = np.array(['Unit {:04d}'.format(i) for i in range(n_units)], dtype=object)
+    lat_lon = np.column_stack([rng.uniform(25, 49, n_units), rng.uniform(-124, -67, n_units)])
+    return SparseFlows(indptr, indices, counts, states, np.arange(1, n_units + 1), np.array(RACES, dtype=object),
+                       np.arange(1, 6), lat_lon)
+
+
+def write_dataset(flows, directory):
+    """
+    Method that writes a FlowTensor as state_to_state_migration.csv, state_lat_lon.csv
+    and the .npy bundle, the files the app loads
+    :param flows: FlowTensor
+    :param directory: directory to write to
+    :return: migration csv path, latitude/longitude csv path
+    """
+    o, d, r, q = (idx.ravel() for idx in np.indices(flows.flows.shape))
+    migration_path = os.path.join(directory, 'state_to_state_migration.csv')
+    lat_lon_path = os.path.join(directory, 'state_lat_lon.csv')
+
+    pd.DataFrame({'o_state_id': flows.state_ids[o], 'o_state_name': flows.states[o],
+                  'd_state_id': flows.state_ids[d], 'd_state_name': flows.states[d],
+                  'race': flows.races[r], 'quintile': flows.quintiles[q],
+                  'n': flows.flows.ravel()}).to_csv(migration_path)
+    pd.DataFrame({'State': flows.states, 'Latitude': flows.lat_lon[:, 0],
+                  'Longitude': flows.lat_lon[:, 1]}).to_csv(lat_lon_path, index=False)
+    create_flow_bundle(migration_path, lat_lon_path)
+    return migration_path, lat_lon_path
+
+
+def measure(name, scale, calls, repeat=1, level='state'):
+    """
+    Method that times every call, then runs them once more under tracemalloc for the peak memory
+    :param name: benchmark name
+    :param scale: dataset scale
+    :param calls: list of zero-argument callables
+    :param repeat: number of timed passes over calls
+    :param level: geographic level of the dataset
+    :return: result dict
+    """
+    timings = []
+    for _ in range(repeat):
+        for call in calls:
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    for call in calls:
+        call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings = np.array(timings) * 1000
+    result = {'name': name, 'level': level, 'scale': scale, 'calls': len(timings),
+              'mean_ms': round(float(timings.mean()), 3),
+              'p50_ms': round(float(np.percentile(timings, 50)), 3),
+              'p90_ms': round(float(np.percentile(timings, 90)), 3),
+              'p99_ms': round(float(np.percentile(timings, 99)), 3),
+              'peak_mb': round(peak / 2 ** 20, 3)}
+    print('{name:<28} {level:<7} {scale:>4}x  p50 {p50_ms:>9.3f} ms  p90 {p90_ms:>9.3f} ms  '
+          'p99 {p99_ms:>9.3f} ms  peak {peak_mb:>8.2f} MB'.format(**result))
+    return result
+
+
+def benchmark_queries(flows, scale, repeat, level='state'):
+    """
+    Method that times the usmap query functions for every source state, and the
+    all-origin averages and the flow ranking index for the dense tensor
+    :param flows: FlowTensor or SparseFlows
+    :param scale: dataset scale, recorded with the results
+    :param repeat: number of passes over the states
+    :param level: geographic level, recorded with the results
+    :return: list of result dicts
+    """
+    results = []
+    for function in STATE_FUNCTIONS:
+        calls = [lambda function=function, source=source: function(flows, source) for source in flows.states]
+        results.append(measure(function.__name__, scale, calls, repeat, level))
+
+    if isinstance(flows, SparseFlows):
+        return results
+
+    results.append(measure('global_average_distance', scale, [lambda: usmap.global_average_distance(flows)], repeat))
+    results.append(measure('origin_averages', scale, [lambda: usmap.origin_averages(flows)], repeat))
+    results.append(measure('flow_ranking', scale, [lambda: usmap.FlowRanking(flows)], repeat))
+    ranking = usmap.flow_ranking(flows)
+    results.append(measure('top_destinations', scale,
+                           [lambda source=source: ranking.top_destinations(source) for source in flows.states], repeat))
+    return results
+
+
+def benchmark_loads(migration_path, lat_lon_path, scale, repeat):
+    """
+    Method that times load_flow_tensor from the bundle, and building the tensor from the csv
+    :param migration_path: path to state_to_state_migration.csv
+    :param lat_lon_path: path to state_lat_lon.csv
+    :param scale: dataset scale, recorded with the results
+    :param repeat: number of timed loads
+    :return: list of result dicts
+    """
+    return [measure('load_data_bundle', scale,
+                    [lambda: usmap.load_flow_tensor(migration_path, lat_lon_path)], repeat),
+            measure('load_data_csv', scale,
+                    [lambda: usmap.build_flow_tensor(pd.read_csv(migration_path, index_col=0),
+                                                     pd.read_csv(lat_lon_path))], repeat)]
+
+
+def benchmark_page(repeat, script='streamlit_app.py'):
+    """
+    Method that runs the Streamlit script headless for every state, with the selectbox
+    returning each state in turn. Without a server Streamlit still builds and serializes
+    every element, it only does not send them. The first run, which loads the data, is
+    reported on its own
+    :param repeat: number of passes over the states
+    :param script: path to the Streamlit script
+    :return: list of result dicts
+    """
+    import streamlit as st
+    from streamlit import logger
+
+    logger.get_logger('streamlit').setLevel('ERROR')
+    code = compile(open(script).read(), script, 'exec')
+    selectbox = st.selectbox
+    source = None
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(code, {'__name__': '__main__', '__file__': script})
+
+    try:
+        # The cohort selector, if there is one, keeps its first cohort
+        st.selectbox = lambda label, options, *args, **kwargs: source if source in list(options) else options[0]
+        states = list(usmap.load_flow_tensor().states)
+        source = states[0]
+        results = [measure('page_render_cold', 1, [run])]
+
+        calls = []
+        for state in states:
+            def call(state=state):
+                nonlocal source
+                source = state
+                run()
+            calls.append(call)
+        results.append(measure('page_render', 1, calls, repeat))
+    finally:
+        st.selectbox = selectbox
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    """
+    Method that prints the median latency of every benchmark relative to a saved run
+    :param results: result dicts of this run
+    :param baseline_path: json file written by a previous run
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(result['name'], result.get('level', 'state'), result['scale']): result
+                for result in baseline['results']}
+
+    print('\ncompared to {} ({})'.format(baseline_path, baseline.get('commit')))
+    for result in results:
+        before = previous.get((result['name'], result['level'], result['scale']))
+        if before is None or not before['p50_ms']:
+            continue
+        print('{:<28} {:<7} {:>4}x  p50 {:>9.3f} -> {:>9.3f} ms  ({:.2f}x)'.format(
+            result['name'], result['level'], result['scale'], before['p50_ms'], result['p50_ms'],
+            result['p50_ms'] / before['p50_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the usmap.py queries, data loading and the page render')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100],
+                        help='dataset sizes relative to the real data, 1 uses the real data')
+    parser.add_argument('--county-units', type=int, default=3000,
+                        help='units of the synthetic sparse county level dataset, 0 skips it')
+    parser.add_argument('--repeat', type=int, default=3, help='timed passes over every state')
+    parser.add_argument('--no-page', action='store_true', help='skip the headless page render')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='json file to write the results to')
+    parser.add_argument('--compare', help='json file from a previous run to compare with')
+    args = parser.parse_args()
+
+    results = []
+    for scale in args.scales:
+        if scale == 1:
+            migration_path, lat_lon_path = 'state_to_state_migration.csv', 'state_lat_lon.csv'
+            results += benchmark_queries(usmap.load_flow_tensor(migration_path, lat_lon_path), scale, args.repeat)
+            results += benchmark_loads(migration_path, lat_lon_path, scale, args.repeat)
+            continue
+
+        flows = synthetic_flows(scale)
+        results += benchmark_queries(flows, scale, args.repeat)
+        with tempfile.TemporaryDirectory() as directory:
+            results += benchmark_loads(*write_dataset(flows, directory), scale, args.repeat)
+
+    if args.county_units:
+        flows = synthetic_sparse_flows(args.county_units)
+        results += benchmark_queries(flows, round(args.county_units / 51), args.repeat, level='county')
+
+    if not args.no_page:
+        results += benchmark_page(args.repeat)
+
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(),
+                   'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'pandas': pd.__version__,
+                   'machine': platform.machine(),
+                   'cpus': os.cpu_count(),
+                   'results': results}, f, indent=2)
+    print('\nwrote {}'.format(args.output))
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,341 @@
+import altair as alt
+import pandas as pd
+from altair.utils import schemapi
+
+from instrumentation import timed
+from usmap import flow_ranking, migration_data, miles_moved_race, miles_moved_race_q, national_statistics, \
+    race_data, us_states_topology
+
+# Altair validates every intermediate chart object while a chart is built, on top of
+# validating the finished spec in to_dict. Only the final validation is kept
+# (altair.utils.schemapi.disable_debug_mode does not turn it off in Altair 4.2)
+schemapi.DEBUG_MODE = False
+
+
+def chart_spec(chart, datasets, inline_values=None):
+    """
+    Method that turns a chart whose data is referenced by name into a Vega-Lite spec.
+    The dataframes are attached under 'datasets' as they are, which st.vega_lite_chart
+    serializes with Arrow, so every dataset is sent once however many charts use it
+    :param chart: altair chart built on alt.NamedData
+    :param datasets: dict from dataset name to dataframe
+    :param inline_values: dict from the name of an alt.InlineData built with empty values
+                          to its values, filled in after the spec is validated
+    :return: spec dict
+    """
+    spec = chart.to_dict()
+    if inline_values:
+        fill_inline_values(spec, inline_values)
+    spec['datasets'] = datasets
+    return spec
+
+
+def fill_inline_values(spec, inline_values):
+    """
+    Method that sets the values of the named inline data of a spec in place. Large values
+    such as the state outlines are left out of the altair objects, which copy and walk
+    them on every chained method call
+    :param spec: spec dict or list from to_dict
+    :param inline_values: dict from inline data name to values
+    """
+    items = spec.items() if isinstance(spec, dict) else enumerate(spec) if isinstance(spec, list) else ()
+    for key, value in items:
+        if key == 'data' and isinstance(value, dict) and value.get('name') in inline_values:
+            value['values'] = inline_values[value['name']]
+        else:
+            fill_inline_values(value, inline_values)
+
+
+@timed
+def map_spec(migration_df, destination_ranks, source):
+    """
+    Method that builds the choropleth of the destinations of the selected state, layered
+    over the selected state itself, and the top 10 destinations bar chart. Both are drawn
+    from the same dataset, the bar keeps the rows ranked in the top 10
+    :param migration_df: df from usmap.migration_data
+    :param destination_ranks: ranks from usmap.FlowRanking.destination_ranks, aligned with migration_df
+    :param source: selected state
+    :return: spec dict
+    """
+    migration = alt.NamedData(name='migration')
+    datasets = {'migration': migration_df[['d_state_id', 'd_state_name', 'n']].assign(rank=destination_ranks)}
+
+    click = alt.selection_multi(fields=['d_state_name'])
+
+    # State outlines are embedded in the spec from the bundled topology instead of fetched
+    # from a CDN. They are filled in by chart_spec once the chart is built
+    states = alt.InlineData(name='us_states', values={},
+                            format=alt.DataFormat(type='topojson', feature='states'))
+
+    # Chart for highlighting the selection
+    selection_chart = alt.Chart(states, width=2000, height=15) \
+        .mark_geoshape().encode(
+        tooltip=[alt.Tooltip('n:Q', title='Population staying back')],
+        color=alt.Color('n:Q', scale=alt.Scale(scheme="yelloworangered"), legend=None)
+    ).transform_lookup(
+        lookup='id',
+        from_=alt.LookupData(migration, 'd_state_id', ['n', 'd_state_name'])
+    ).transform_filter(
+        alt.datum.d_state_name == source
+    ).properties(
+        width=600,
+        height=500
+    ).project(
+        type='albersUsa'
+    )
+
+    # Adding our data to the chart
+    #https://altair-viz.github.io/gallery/choropleth.html
+    migration_chart = alt.Chart(states, width=2000, height=15,
+                                title='Choropleth showing the number of people migrating from {}'.format(source)) \
+        .mark_geoshape(
+        stroke='lightgray'
+    ).encode(
+        tooltip=[alt.Tooltip('d_state_name:O', title='State'),
+                 alt.Tooltip('n:Q', title='# moved here')],
+        color=alt.Color('n:Q',
+                        title="Population migrating"),
+        opacity=alt.condition(click, alt.value(1), alt.value(0.2))
+    ).transform_lookup(
+        lookup='id',
+        from_=alt.LookupData(migration, 'd_state_id', ['n', 'd_state_name'])
+    ).transform_filter(
+        alt.datum.d_state_name != source
+    ).properties(
+        width=600,
+        height=500
+    ).project(
+        type='albersUsa'
+    ).add_selection(click)
+
+    usmap = alt.layer(selection_chart,
+                      migration_chart).resolve_scale(color='independent')
+
+    #https://stackoverflow.com/questions/63751130/altair-choropleth-map-color-highlight-based-on-line-chart-selection
+    popular_state_bar = alt.Chart(
+                            migration,
+                            title='Top 10 states young adults migrated to from {}'.format(source),
+                            width=600).\
+                            mark_bar().encode(
+                                x=alt.X('n:Q', title="Population migrating"),
+                                opacity=alt.condition(click, alt.value(1), alt.value(0.2)),
+                                color=alt.Color('n:Q', legend=None),
+                                y=alt.Y('d_state_name:N', sort='-x', title="Destination States"),
+                                tooltip=[alt.Tooltip('n:Q', title="# of people")]
+                        ).transform_filter(
+                            alt.datum.rank <= 10
+                        ).add_selection(click)
+
+    return chart_spec(alt.vconcat(usmap, popular_state_bar, center=True), datasets,
+                      inline_values={'us_states': us_states_topology()})
+
+
+@timed
+def race_spec(race_df, quintile_df, source, selected_race):
+    """
+    Method that builds the bar chart of people leaving the selected state by race, and
+    the pie chart of the race picked in it by quintile
+    :param race_df: race df from usmap.race_data
+    :param quintile_df: quintile df from usmap.race_data
+    :param source: selected state
+    :param selected_race: race selected when the page loads
+    :return: spec dict
+    """
+    datasets = {'race': race_df[['race', 'n']],
+                'race_quintile': quintile_df[['race', 'quintile', 'n']]}
+
+    brush = alt.selection_single(encodings=["y"], init={'race': selected_race}, empty='none')
+
+    race_barchart = alt.Chart(alt.NamedData(name='race'),
+    title='Population migration from {} by Race'.format(source),
+        width=420).mark_bar().encode(
+        x=alt.X('n:Q', title="Population migrating"),
+        y=alt.Y('race:N', title="Race"),
+        opacity = alt.condition(brush, alt.value(1), alt.value(0.8)),
+        tooltip=[alt.Tooltip('n:Q', title="# of people")]
+    ).add_selection(brush)
+
+    race_quintile_chart = alt.Chart(alt.NamedData(name='race_quintile'),
+        title = 'Population migrating by selected race').encode(
+        theta=alt.Theta("n:Q", stack=True), color=alt.Color("quintile:N"),
+        tooltip=[alt.Tooltip('quintile:N', title='Quintile')]
+    ).transform_filter(brush)
+
+    pie = race_quintile_chart.mark_arc(outerRadius=100, innerRadius = 60)
+    text = race_quintile_chart.mark_text(radius=125, size=16).encode(
+        text="n:Q",
+        opacity=alt.condition(brush, alt.value(1), alt.value(0)))
+
+    race_quintile_chart_comb = pie + text
+
+    return chart_spec(alt.hconcat(race_barchart, race_quintile_chart_comb, center=True), datasets)
+
+
+@timed
+def inbound_spec(top_origins_df, destination, group):
+    """
+    Method that builds the bar chart of the states most young adults moving to the
+    selected state come from
+    :param top_origins_df: df from usmap.FlowRanking.top_origins
+    :param destination: selected state
+    :param group: description of the people counted, such as 'young adults'
+    :return: spec dict
+    """
+    inbound_bar = alt.Chart(alt.NamedData(name='top_origins'),
+                            title='Top {} states {} moved to {} from'.format(len(top_origins_df), group, destination),
+                            width=600).mark_bar().encode(
+        x=alt.X('n:Q', title='Population migrating'),
+        y=alt.Y('o_state_name:N', sort='-x', title='Origin States'),
+        color=alt.Color('n:Q', legend=None),
+        tooltip=[alt.Tooltip('n:Q', title='# of people')]
+    )
+    return chart_spec(inbound_bar, {'top_origins': top_origins_df[['o_state_name', 'n']]})
+
+
+@timed
+def distance_spec(miles_moved_race_df, miles_moved_race_q_df, national_race_df, source):
+    """
+    Method that builds the average distance charts by race and by quintile, and the
+    comparison of the selected race with its national average
+    :param miles_moved_race_df: df from usmap.miles_moved_race, or the race df from
+                                usmap.distance_intervals to draw error bars
+    :param miles_moved_race_q_df: df from usmap.miles_moved_race_q, or the race_quintile df
+                                  from usmap.distance_intervals
+    :param national_race_df: 'race' df from usmap.national_statistics
+    :param source: selected state
+    :return: spec dict
+    """
+    #Referred from
+    #https://altair-viz.github.io/gallery/isotype_emoji.html
+    #https://medium.com/dataexplorations/how-to-add-emojis-to-an-altair-chart-f9bc02da3a4b
+    avg_df = national_race_df.rename(columns={'Distance': 'Value'})
+    avg_df['icon'] = '🇺🇸'
+    max_distance = max(miles_moved_race_df['Distance'].max(), avg_df['Value'].max())
+
+    interval_columns = ['Lower', 'Upper'] if 'Lower' in miles_moved_race_df else []
+    datasets = {'race_distance': miles_moved_race_df[['Race', 'Distance'] + interval_columns].assign(icon='👨'),
+                'race_quintile_distance': miles_moved_race_q_df[['Race', 'Quintile', 'Distance'] + interval_columns],
+                'national_distance': avg_df[['Race', 'Value', 'icon']],
+                'line': pd.DataFrame({'y': [1]})}
+
+    race_brush = alt.selection_single(encodings=['y'])
+    distance_moved_race_bar = alt.Chart(
+                                    alt.NamedData(name='race_distance'),
+                                    height=100,
+                                    title='Average distance moved by each race from {}'.format(source))\
+                                    .mark_bar().encode(
+                                        x=alt.X('Distance:Q', title='Distance moved in miles'),
+                                        y=alt.Y('Race:N', title="Race"),
+                                        opacity=alt.condition(race_brush, alt.value(1), alt.value(0.2)),
+                                        tooltip=[alt.Tooltip('Distance:Q', title='Distance moved')]
+                                    ).add_selection(race_brush)
+
+    distance_moved_race_q_bar = alt.Chart(
+                                    alt.NamedData(name='race_quintile_distance'),
+                                    width=180,
+                                    title='Average distance moved by each quintile from {}'.format(source))\
+                                    .mark_bar().encode(
+                                        y=alt.Y('Distance:Q', title='Distance moved in miles'),
+                                        x=alt.X('Quintile:O', title="Income Quantile"),
+                                        tooltip=[alt.Tooltip('Distance:Q', title='Distance moved')],
+                                        color='Race:N'
+                                    ).transform_filter(race_brush)
+
+    if interval_columns:
+        interval_tooltip = [alt.Tooltip('Lower:Q', title='95% interval from'),
+                            alt.Tooltip('Upper:Q', title='95% interval to')]
+        race_error_bars = alt.Chart(alt.NamedData(name='race_distance')).mark_rule().encode(
+            x='Lower:Q', x2='Upper:Q', y='Race:N', tooltip=interval_tooltip)
+        race_q_error_bars = alt.Chart(alt.NamedData(name='race_quintile_distance')).mark_rule().encode(
+            x='Quintile:O', y='Lower:Q', y2='Upper:Q', tooltip=interval_tooltip).transform_filter(race_brush)
+        distance_moved_race_bar = distance_moved_race_bar + race_error_bars
+        distance_moved_race_q_bar = distance_moved_race_q_bar + race_q_error_bars
+
+    race_dist = alt.Chart(
+        alt.NamedData(name='race_distance'),
+        title="Distance moved by selected race vs National Average",
+        height=75)\
+        .mark_text(filled=True, size=25, baseline='middle').encode(
+            x=alt.X('Distance:Q', title="Distance moved in miles", axis=alt.Axis(grid=False),
+                    scale=alt.Scale(domain=[0, max_distance+200])),
+            text=alt.Text('icon:N'),
+            tooltip=[alt.Tooltip('Distance:Q', title='Distance')]
+        ).transform_filter(race_brush)
+
+    avg_dist = alt.Chart(
+        alt.NamedData(name='national_distance'),
+        height=75)\
+        .mark_text(filled=True, size=25, baseline='middle').encode(
+            x=alt.X('Value:Q', scale=alt.Scale(domain=[0, max_distance+200])),
+            text=alt.Text('icon:N'),
+            tooltip=[alt.Tooltip('Value:Q', title='Distance')]
+        ).transform_filter(race_brush)
+
+    line = alt.Chart(alt.NamedData(name='line'))\
+        .mark_rule().encode(y=alt.Y('y:Q', axis=alt.Axis(tickSize=0, labelFontSize=0), title=None))
+
+    dist_plot = race_dist + avg_dist + line
+    combo2 = alt.hconcat(distance_moved_race_bar, distance_moved_race_q_bar, center=True)
+    return chart_spec(alt.vconcat(combo2, dist_plot), datasets)
+
+
+@timed
+def chart_specs(flows, source):
+    """
+    Method that builds every chart spec of the page for the selected state, so that
+    they can be computed ahead of time and cached like the other per-state queries
+    :param flows: FlowTensor
+    :param source: selected state
+    :return: dict with 'map', 'race' and 'distance' specs
+    """
+    race_df, quintile_df = race_data(flows, source)
+    ranking = flow_ranking(flows)
+    return {'map': map_spec(migration_data(flows, source), ranking.destination_ranks(source), source),
+            'race': race_spec(race_df, quintile_df, source, ranking.dominant_race(source)),
+            'distance': distance_spec(miles_moved_race(flows, source), miles_moved_race_q(flows, source),
+                                      national_statistics(flows)['race'], source)}
+
+
+@timed
+def trend_spec(comparison, source, cohort, names):
+    """
+    Method that builds the line chart of the average distance moved by each race across
+    cohorts, and the bar chart of the destinations whose arrivals changed the most in the
+    selected cohort compared to the first one
+    :param comparison: dict from usmap.cohort_comparison
+    :param source: selected state
+    :param cohort: selected cohort
+    :param names: cohorts in the order they are compared, the first one is the baseline
+    :return: spec dict
+    """
+    destinations_df = comparison['destinations']
+    datasets = {'cohort_distance': comparison['race_distance'],
+                'cohort_destinations': destinations_df.loc[destinations_df['Cohort'] == cohort,
+                                                           ['d_state_name', 'n', 'Change']]}
+
+    trend_chart = alt.Chart(alt.NamedData(name='cohort_distance'),
+                            title='Average distance moved by each race from {} by cohort'.format(source),
+                            width=420).mark_line(point=True).encode(
+        x=alt.X('Cohort:O', sort=list(names), title='Cohort'),
+        y=alt.Y('Distance:Q', title='Distance moved in miles'),
+        color=alt.Color('Race:N'),
+        tooltip=[alt.Tooltip('Race:N'), alt.Tooltip('Distance:Q', title='Distance moved'),
+                 alt.Tooltip('Change:Q', title='Change since {}'.format(names[0]))]
+    )
+    if cohort == names[0]:
+        return chart_spec(trend_chart, datasets)
+
+    change_chart = alt.Chart(alt.NamedData(name='cohort_destinations'),
+                             title='Destinations that changed the most since {}'.format(names[0]),
+                             width=420).\
+        transform_filter(alt.datum.d_state_name != source).\
+        transform_calculate(size='abs(datum.Change)').\
+        transform_window(rank='row_number()', sort=[alt.SortField('size', order='descending')]).\
+        transform_filter(alt.datum.rank <= 10).\
+        mark_bar().encode(
+            x=alt.X('Change:Q', title='Change in population migrating'),
+            y=alt.Y('d_state_name:N', sort='-x', title='Destination States'),
+            color=alt.condition(alt.datum.Change > 0, alt.value('steelblue'), alt.value('orange')),
+            tooltip=[alt.Tooltip('n:Q', title='# of people'), alt.Tooltip('Change:Q', title='Change')]
+        )
+    return chart_spec(alt.hconcat(trend_chart, change_chart), datasets)
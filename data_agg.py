@@ -1,46 +1,263 @@
-import pandas as pd
-from vega_datasets import data
-
-def create_state_csv():
-    df = pd.read_csv('C:/Users/anjby/IDS/abnormal_distribution/MigrationPatternsData/od.csv')
-    df.info(verbose=True, show_counts=True)
-
-    grouped_df = df.groupby(['o_state_name', 'd_state_name', 'pool'])['n']\
-                .agg('sum')\
-                .reset_index()
-    
-    # Splitting the pool in to state and quantile
-
-    splits = grouped_df['pool'].str.split('Q', expand=True)
-    grouped_df['race'] = splits[0]
-    grouped_df['quintile'] = splits[1]
-    grouped_df.drop(['pool'], axis=1, inplace=True)
-
-    # Adding unique identifier for source and destination states
-    pop = data.population_engineers_hurricanes()
-
-    pop = pop[['state', 'id']]
-    states = list(pop['state'])
-    ids = list(pop['id'])
-
-    ## Source state
-    state_id_dict = {}
-
-    for idx, state in zip(ids, states):
-        if state == "District of Columbia":
-            state_id_dict["DC"] = idx
-        else:
-            state_id_dict[state] = idx
-
-    
-    def assign_state_id(state):
-        return state_id_dict[state]
-
-    grouped_df['o_state_id'] = grouped_df.apply(lambda x: assign_state_id(x['o_state_name']), axis=1)
-    grouped_df['d_state_id'] = grouped_df.apply(lambda x: assign_state_id(x['d_state_name']), axis=1)
-
-    col_order = ['o_state_id', 'o_state_name', 'd_state_id', 'd_state_name',
-                'race', 'quintile', 'n']
-    grouped_df = grouped_df.reindex(columns=col_order)
-
-    grouped_df.to_csv('state_to_state_migration.csv')
\ No newline at end of file
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from sparse_flows import build_sparse_flows, write_sparse_bundle
+from usmap import COHORTS_MANIFEST, DataValidationError, build_flow_tensor, data_version, default_bundle_path, \
+    register_cohort, update_flow_bundle
+
+GROUP_KEYS = ['o_state_name', 'd_state_name', 'pool']
+# od.csv columns holding the origin and destination unit at each geographic level
+LEVEL_COLUMNS = {'state': ('o_state_name', 'd_state_name'),
+                 'cz': ('o_cz', 'd_cz'),
+                 'county': ('o_cty', 'd_cty')}
+
+
+def level_keys(level):
+    return list(LEVEL_COLUMNS[level]) + ['pool']
+
+
+def aggregate_chunk(chunk, keys=GROUP_KEYS):
+    """
+    Partial sum of the migration counts in one chunk of od.csv
+    :param chunk: df with the key columns and n
+    :param keys: columns to group by, origin, destination and pool
+    :return: series of n indexed by keys
+    """
+    return chunk.groupby(keys)['n'].sum()
+
+
+def merge_partials(partials):
+    """
+    Merges partial sums into one, keeping integer counts
+    :param partials: list of series returned by aggregate_chunk
+    :return: series of n indexed like the partials
+    """
+    return pd.concat(partials).groupby(level=list(range(partials[0].index.nlevels))).sum()
+
+
+def aggregate_od(od_path, chunksize=1_000_000, workers=1, keys=GROUP_KEYS):
+    """
+    Streams od.csv in chunks and sums the counts for every origin state, destination
+    state and pool. Only the running total and at most 2 * workers chunks are held in
+    memory, and the total can never have more rows than there are state pairs x pools
+    :param od_path: path to the county level od.csv
+    :param chunksize: number of rows read per chunk
+    :param workers: number of processes aggregating chunks, 1 aggregates in this process
+    :param keys: columns to group by, state level by default
+    :return: series of n indexed by keys
+    """
+    chunks = pd.read_csv(od_path, usecols=keys + ['n'], chunksize=chunksize)
+    total = None
+
+    def fold(partials):
+        nonlocal total
+        total = merge_partials(partials if total is None else [total] + partials)
+
+    if workers <= 1:
+        for chunk in chunks:
+            fold([aggregate_chunk(chunk, keys)])
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = []
+            for chunk in chunks:
+                pending.append(executor.submit(aggregate_chunk, chunk, keys))
+                if len(pending) >= 2 * workers:
+                    fold([future.result() for future in pending])
+                    pending = []
+            if pending:
+                fold([future.result() for future in pending])
+
+    if total is None:
+        raise ValueError('{} has no rows'.format(od_path))
+    return total
+
+
+PARTIALS_MANIFEST = 'manifest.json'
+
+
+def aggregate_extracts(od_paths, store_path=None, chunksize=1_000_000, workers=1, level='state'):
+    """
+    Sums the counts over several od.csv extracts. With a store, the partial sum of each
+    extract is kept on disk under its content hash, and only extracts that are new or
+    whose content changed since the last run are read again. Extracts recorded in the
+    store but missing from od_paths are retracted from it
+    :param od_paths: paths to every od.csv extract that makes up the data
+    :param store_path: directory of the partial sums, None aggregates everything
+    :param chunksize: number of rows read per chunk
+    :param workers: number of processes aggregating chunks
+    :param level: geographic level of the origins and destinations, a key of LEVEL_COLUMNS
+    :return: series of n indexed by origin, destination and pool
+    """
+    keys = level_keys(level)
+    if store_path is None:
+        return merge_partials([aggregate_od(path, chunksize, workers, keys) for path in od_paths])
+
+    # Every level keeps its own partial sums and manifest
+    suffix = '' if level == 'state' else '-' + level
+    os.makedirs(store_path, exist_ok=True)
+    manifest_path = os.path.join(store_path, os.path.splitext(PARTIALS_MANIFEST)[0] + suffix + '.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    current = {}
+    partials = []
+    for path in od_paths:
+        key = os.path.abspath(path)
+        checksum = data_version(path)
+        partial_path = os.path.join(store_path, checksum + suffix + '.csv')
+        if not os.path.exists(partial_path):
+            # Renamed into place once complete, an interrupted run leaves no partial sum to trust
+            aggregate_od(path, chunksize, workers, keys).to_csv(partial_path + '.tmp')
+            os.replace(partial_path + '.tmp', partial_path)
+        current[key] = checksum
+        partials.append(pd.read_csv(partial_path, index_col=list(range(len(keys))))['n'])
+
+    # Drop the partial sums of extracts that were replaced or retracted
+    for checksum in set(manifest.values()) - set(current.values()):
+        partial_path = os.path.join(store_path, checksum + suffix + '.csv')
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(current, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return merge_partials(partials)
+
+
+def state_id_lookup(path='state_ids.csv'):
+    """
+    Unique identifier for every state, as used by the bundled us_states_topo.json
+    :param path: path to state_ids.csv
+    :return: dict from state name (DC for the District of Columbia) to id
+    """
+    ids = pd.read_csv(path)
+    return dict(zip(ids['state'], ids['id']))
+
+
+def assign_state_ids(names, state_id_dict):
+    ids = names.map(state_id_dict)
+    unknown = names[ids.isna()].unique()
+    if len(unknown):
+        raise KeyError('No state id for {}'.format(', '.join(map(str, unknown))))
+    return ids
+
+
+def split_pool(grouped_df):
+    # Splitting the pool in to state and quantile
+
+    splits = grouped_df['pool'].str.split('Q', expand=True)
+    grouped_df['race'] = splits[0]
+    grouped_df['quintile'] = splits[1]
+    grouped_df.drop(['pool'], axis=1, inplace=True)
+    return grouped_df
+
+
+def create_state_csv(od_paths='od.csv', output_path='state_to_state_migration.csv',
+                     lat_lon_path='state_lat_lon.csv', chunksize=1_000_000, workers=1, store_path=None,
+                     state_ids_path='state_ids.csv'):
+    if isinstance(od_paths, str):
+        od_paths = [od_paths]
+    grouped_df = split_pool(aggregate_extracts(od_paths, store_path, chunksize=chunksize, workers=workers)
+                            .reset_index())
+
+    # Adding unique identifier for source and destination states
+    state_id_dict = state_id_lookup(state_ids_path)
+
+    grouped_df['o_state_id'] = assign_state_ids(grouped_df['o_state_name'], state_id_dict)
+    grouped_df['d_state_id'] = assign_state_ids(grouped_df['d_state_name'], state_id_dict)
+
+    col_order = ['o_state_id', 'o_state_name', 'd_state_id', 'd_state_name',
+                'race', 'quintile', 'n']
+    grouped_df = grouped_df.reindex(columns=col_order)
+
+    grouped_df.to_csv(output_path)
+
+    create_flow_bundle(output_path, lat_lon_path)
+
+
+def create_flow_bundle(migration_path='state_to_state_migration.csv', lat_lon_path='state_lat_lon.csv'):
+    """
+    Writes the columnar .npy bundle that the app memory-maps instead of parsing the csv.
+    The csv is validated first, see usmap.validate_migration. The national statistics stored
+    in it are only recomputed for origins whose counts changed
+    """
+    flows = build_flow_tensor(pd.read_csv(migration_path, index_col=0), pd.read_csv(lat_lon_path))
+    update_flow_bundle(flows, default_bundle_path(migration_path), migration_path, lat_lon_path)
+
+
+def create_unit_flows(od_paths, level, units_path, output_path, chunksize=1_000_000, workers=1, store_path=None):
+    """
+    Aggregates od.csv at commuting zone or county level and writes the sparse flow bundle
+    :param od_paths: paths to every od.csv extract that makes up the data
+    :param level: 'cz' or 'county'
+    :param units_path: csv with one row per unit: unit (the id used in od.csv), id,
+                       Latitude, Longitude and optionally a unique name
+    :param output_path: directory to write the bundle to
+    """
+    origin_col, dest_col = LEVEL_COLUMNS[level]
+    grouped_df = split_pool(aggregate_extracts(od_paths, store_path, chunksize=chunksize, workers=workers,
+                                               level=level).reset_index())
+    grouped_df['quintile'] = grouped_df['quintile'].astype(int)
+
+    flows = build_sparse_flows(grouped_df, pd.read_csv(units_path), origin_col, dest_col)
+    write_sparse_bundle(flows, output_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Aggregate the county level od.csv to state_to_state_migration.csv')
+    parser.add_argument('od_paths', nargs='+', metavar='od_path',
+                        help='county level od.csv extracts, all of them are summed')
+    parser.add_argument('-o', '--output', default=None,
+                        help='state level csv to write, the .npy bundle is written next to it. For the cz and '
+                             'county levels, the directory of the sparse bundle (default <level>_migration)')
+    parser.add_argument('--level', choices=sorted(LEVEL_COLUMNS), default='state',
+                        help='geographic level of the origins and destinations')
+    parser.add_argument('--units', help='csv describing the cz or county units: unit, id, Latitude, Longitude, name. '
+                                        'Names must be unique, e.g. "Washington County, OH"')
+    parser.add_argument('--lat-lon', default='state_lat_lon.csv', help='path to state_lat_lon.csv')
+    parser.add_argument('--state-ids', default='state_ids.csv', help='path to state_ids.csv')
+    parser.add_argument('--chunksize', type=int, default=1_000_000, help='rows of od.csv read at a time')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='processes aggregating chunks, 0 uses every core')
+    parser.add_argument('--store', default=None,
+                        help='directory keeping the partial sum of every extract, so that only new, changed '
+                             'or removed extracts are aggregated again on the next run')
+    parser.add_argument('--cohort', help='state level: add the output to cohorts.json under this cohort name, '
+                                         'written to cohorts/<cohort>.csv unless -o is given')
+    parser.add_argument('--cohort-label', help='description of the cohort shown in the app')
+    parser.add_argument('--cohorts', default=COHORTS_MANIFEST, help='path to cohorts.json')
+    args = parser.parse_args()
+
+    if args.level != 'state':
+        if args.units is None:
+            parser.error('--units is required for --level {}'.format(args.level))
+        try:
+            create_unit_flows(args.od_paths, args.level, args.units, args.output or args.level + '_migration',
+                              chunksize=args.chunksize, workers=args.workers or os.cpu_count(), store_path=args.store)
+        except DataValidationError as e:
+            parser.exit(1, '{}\n'.format(e))
+        return
+
+    output = args.output or 'state_to_state_migration.csv'
+    if args.cohort and not args.output:
+        output = os.path.join(os.path.dirname(args.cohorts), 'cohorts', args.cohort + '.csv')
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    try:
+        create_state_csv(args.od_paths, output, args.lat_lon, chunksize=args.chunksize,
+                         workers=args.workers or os.cpu_count(), store_path=args.store, state_ids_path=args.state_ids)
+    except DataValidationError as e:
+        parser.exit(1, '{}\n'.format(e))
+    if args.cohort:
+        register_cohort(args.cohort, output, args.cohort_label, args.cohorts)
+
+
+if __name__ == '__main__':
+    main()
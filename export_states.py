@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from usmap import COHORTS_MANIFEST, STATE_QUERIES, FlowTensor, load_flow_tensor, migration_data, miles_moved_race, \
+    miles_moved_race_q, origin_averages, race_data, read_cohorts
+
+# Consolidated tables written by export_states, one row group of each per source state
+EXPORT_TABLES = ('migration', 'race', 'race_quintile', 'miles_moved_race', 'miles_moved_race_q')
+
+HTML_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+  <meta charset="utf-8">
+  <title>{title}</title>
+  <script src="https://cdn.jsdelivr.net/npm/vega@5"></script>
+  <script src="https://cdn.jsdelivr.net/npm/vega-lite@4.17.0"></script>
+  <script src="https://cdn.jsdelivr.net/npm/vega-embed@6"></script>
+</head>
+<body>
+  <h1>{title}</h1>
+  <div id="map"></div>
+  <div id="race"></div>
+  <div id="distance"></div>
+  <script>
+    const specs = {specs};
+    for (const [name, spec] of Object.entries(specs)) {{
+      vegaEmbed('#' + name, spec, {{mode: 'vega-lite'}});
+    }}
+  </script>
+</body>
+</html>
+"""
+
+# Set in every worker by attach_flows: the tensor read from shared memory and where to write html
+_worker = {}
+
+
+def share_flows(flows):
+    """
+    Method that copies the count tensor into a shared memory block, so that the export
+    workers read it without each holding or unpickling a copy
+    :param flows: FlowTensor
+    :return: SharedMemory block, and the arguments attach_flows needs to rebuild the tensor
+    """
+    counts = np.ascontiguousarray(flows.flows)
+    block = shared_memory.SharedMemory(create=True, size=max(counts.nbytes, 1))
+    np.ndarray(counts.shape, dtype=counts.dtype, buffer=block.buf)[:] = counts
+    return block, (block.name, counts.shape, counts.dtype.str, flows.states, flows.state_ids, flows.races,
+                   flows.quintiles, flows.lat_lon, flows.origin_averages)
+
+
+def attach_flows(name, shape, dtype, states, state_ids, races, quintiles, lat_lon, averages, html_dir=None):
+    """
+    Process pool initializer that maps the shared count tensor read-only into the worker
+    """
+    block = shared_memory.SharedMemory(name=name)
+    counts = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    counts.flags.writeable = False
+
+    flows = FlowTensor(counts, states, state_ids, races, quintiles, lat_lon)
+    flows.origin_averages = averages
+    _worker.update(block=block, flows=flows, html_dir=html_dir)
+
+
+def state_tables(flows, source):
+    """
+    Method that runs the usmap query functions for one source state
+    :param flows: FlowTensor
+    :param source: source state
+    :return: dict from the names in EXPORT_TABLES to dataframes with a source column
+    """
+    race_df, quintile_df = race_data(flows, source)
+    tables = {'migration': migration_data(flows, source)[['d_state_id', 'd_state_name', 'n']],
+              'race': race_df.drop(columns='o_state_name'),
+              'race_quintile': quintile_df.drop(columns='o_state_name'),
+              'miles_moved_race': miles_moved_race(flows, source),
+              'miles_moved_race_q': miles_moved_race_q(flows, source)}
+    return {name: df.assign(source=source)[['source'] + list(df.columns)] for name, df in tables.items()}
+
+
+def html_page(specs, title):
+    """
+    Method that turns the chart specs of a state into a standalone page rendered with vega-embed
+    :param specs: dict from charts.chart_specs, whose datasets are dataframes
+    :param title: page title
+    :return: html string
+    """
+    def inline(spec):
+        datasets = {name: json.loads(df.to_json(orient='records')) for name, df in spec['datasets'].items()}
+        return dict(spec, datasets=datasets)
+
+    return HTML_TEMPLATE.format(title=title, specs=json.dumps({name: inline(spec) for name, spec in specs.items()}))
+
+
+def html_file_name(source):
+    return source.replace(' ', '_') + '.html'
+
+
+def export_state(source):
+    """
+    Work unit of the process pool: the tables of one state, and its html page when asked for
+    :param source: source state
+    :return: dict from state_tables
+    """
+    flows = _worker['flows']
+    tables = state_tables(flows, source)
+
+    if _worker['html_dir'] is not None:
+        # Altair is only imported by the workers that render pages
+        from charts import chart_specs
+
+        page = html_page(chart_specs(flows, source), 'Young adults migrating from {}'.format(source))
+        with open(os.path.join(_worker['html_dir'], html_file_name(source)), 'w', encoding='utf-8') as f:
+            f.write(page)
+    return tables
+
+
+def export_states(flows, output_path, html_dir=None, workers=None, sources=None):
+    """
+    Method that computes the per-state statistics of every source state across a process
+    pool and writes them as one parquet file per query, each with a source column. The
+    count tensor is placed in shared memory once and mapped by every worker
+    :param flows: FlowTensor
+    :param output_path: directory to write the parquet files to
+    :param html_dir: directory for a static html page of the charts of every state, None skips them
+    :param workers: number of processes, defaults to the number of cores
+    :param sources: source states to export, all states by default
+    :return: dict from the names in EXPORT_TABLES to the consolidated dataframes
+    """
+    sources = list(flows.states if sources is None else sources)
+    workers = min(workers or os.cpu_count(), len(sources))
+    os.makedirs(output_path, exist_ok=True)
+    if html_dir is not None:
+        os.makedirs(html_dir, exist_ok=True)
+
+    if html_dir is not None and flows.origin_averages is None:
+        # Computed once here rather than by every worker drawing the national averages
+        flows.origin_averages = origin_averages(flows)
+
+    block, shared = share_flows(flows)
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=attach_flows,
+                                 initargs=shared + (html_dir,)) as executor:
+            results = list(executor.map(export_state, sources, chunksize=max(1, len(sources) // (4 * workers))))
+    finally:
+        block.close()
+        block.unlink()
+
+    tables = {name: pd.concat([result[name] for result in results], ignore_index=True) for name in EXPORT_TABLES}
+    for name, df in tables.items():
+        path = os.path.join(output_path, name + '.parquet')
+        df.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+    return tables
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export the results of the {} queries for every source state'.format(
+            ', '.join(query.__name__ for query in STATE_QUERIES)))
+    parser.add_argument('-o', '--output', default='state_export',
+                        help='directory to write one parquet file per query to')
+    parser.add_argument('--html', metavar='DIR', help='also write a static html page with the charts of every state')
+    parser.add_argument('-j', '--workers', type=int, default=0, help='processes computing states, 0 uses every core')
+    parser.add_argument('--states', nargs='+', metavar='STATE', help='only export these source states')
+    parser.add_argument('--migration', default='state_to_state_migration.csv', help='path to state_to_state_migration.csv')
+    parser.add_argument('--lat-lon', default='state_lat_lon.csv', help='path to state_lat_lon.csv')
+    parser.add_argument('--cohort', help='export this cohort of cohorts.json instead of the --migration csv')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.cohort:
+        cohorts = read_cohorts(COHORTS_MANIFEST, args.lat_lon)
+        if args.cohort not in cohorts.names:
+            parser.error('unknown cohort {}, cohorts.json has {}'.format(args.cohort, ', '.join(cohorts.names)))
+        flows = cohorts.flows(args.cohort)
+    else:
+        flows = load_flow_tensor(args.migration, args.lat_lon)
+    unknown = sorted(set(args.states or []) - set(flows.states))
+    if unknown:
+        parser.error('unknown states: {}'.format(', '.join(unknown)))
+
+    tables = export_states(flows, args.output, args.html, args.workers or None, args.states)
+    print('exported {} states to {} in {:.2f} s'.format(
+        tables['race']['source'].nunique(), args.output, time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+import contextlib
+import functools
+import io
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('migration_patterns')
+
+# Streamlit runs every session's script in its own thread, so each rerun records into
+# the recorder of its thread, and nothing is recorded where no recorder was started
+_local = threading.local()
+
+
+class RerunRecorder:
+    """
+    Timings collected during one run of the Streamlit script, by timed functions and sections
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = {}
+        self.calls = {}
+        self.fields = {}
+        # Sections of the page may be computed in other threads, see in_rerun
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        """
+        :return: dict with the total and per name milliseconds, call counts and extra fields
+        """
+        return dict(self.fields,
+                    total_ms=round(self.elapsed() * 1000, 3),
+                    timings_ms={name: round(seconds * 1000, 3) for name, seconds in self.timings.items()},
+                    calls=self.calls)
+
+
+def log_to_stderr():
+    """
+    Method that writes the rerun log lines to stderr as bare json, unless a handler was already set up
+    """
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def current_recorder():
+    return getattr(_local, 'recorder', None)
+
+
+def start_rerun():
+    """
+    Method that starts recording for the current thread
+    :return: RerunRecorder
+    """
+    _local.recorder = RerunRecorder()
+    return _local.recorder
+
+
+def finish_rerun(**fields):
+    """
+    Method that stops recording for the current thread and writes one structured log line
+    :param fields: extra fields for the log line, such as the selected state
+    :return: summary dict of the rerun, None if nothing was recording
+    """
+    recorder = current_recorder()
+    if recorder is None:
+        return None
+    _local.recorder = None
+    recorder.fields.update(fields)
+    summary = recorder.summary()
+    logger.info(json.dumps(dict(summary, event='rerun'), default=str))
+    return summary
+
+
+def in_rerun(function):
+    """
+    Method that binds a function to the current thread's recorder, so that what it times
+    while running in a worker thread is recorded with the rerun that started it
+    :param function: function to run in another thread
+    :return: wrapped function
+    """
+    recorder = current_recorder()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        _local.recorder = recorder
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.recorder = None
+    return wrapper
+
+
+def mark(name):
+    """
+    Method that records the time since the start of the rerun as the field name_ms, such
+    as the time until the first chart is sent
+    :param name: field name
+    """
+    recorder = current_recorder()
+    if recorder is not None:
+        recorder.fields[name + '_ms'] = round(recorder.elapsed() * 1000, 3)
+
+
+def timed(function):
+    """
+    Decorator that adds the run time of every call to the current rerun's recorder. With
+    no recorder it only costs a thread-local lookup
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        recorder = getattr(_local, 'recorder', None)
+        if recorder is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.add(function.__name__, time.perf_counter() - start)
+    return wrapper
+
+
+@contextlib.contextmanager
+def section(name):
+    """
+    Context manager that records the time spent in a block of the script under name
+    """
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - start)
+
+
+class Profiler:
+    """
+    Optional profile of a whole rerun, with cProfile or with pyinstrument when it is installed
+    """
+
+    def __init__(self, kind='cprofile'):
+        """
+        :param kind: 'pyinstrument', anything else, or pyinstrument not being installed, uses cProfile
+        """
+        self.kind = 'cprofile'
+        if kind == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as PyinstrumentProfiler
+            except ImportError:
+                pass
+            else:
+                self.kind = kind
+                self._profiler = PyinstrumentProfiler()
+        if self.kind == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        self._profiler.start() if self.kind == 'pyinstrument' else self._profiler.enable()
+
+    def stop(self, limit=30):
+        """
+        Method that stops profiling
+        :param limit: number of functions listed by cProfile
+        :return: text report
+        """
+        if self.kind == 'pyinstrument':
+            self._profiler.stop()
+            return self._profiler.output_text()
+
+        import pstats
+        self._profiler.disable()
+        out = io.StringIO()
+        pstats.Stats(self._profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
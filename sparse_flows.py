@@ -0,0 +1,188 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from usmap import DataValidationError, distance_matrix, examples
+
+SPARSE_BUNDLE_ARRAYS = ('indptr', 'indices', 'counts', 'states', 'state_ids', 'races', 'quintiles', 'lat_lon')
+
+
+class SparseFlows:
+    """
+    Origin x destination flows stored as compressed sparse rows, for geographies such as
+    counties or commuting zones where most pairs of units see nobody moving. Row o holds
+    the destination codes indices[indptr[o]:indptr[o + 1]] and their race x quintile
+    counts, so a query only ever expands one origin to a dense array. It answers the
+    usmap query functions (migration_data, race_data, miles_moved_race, miles_moved_race_q)
+    like FlowTensor does, with the units in place of the states.
+    """
+
+    def __init__(self, indptr, indices, counts, states, state_ids, races, quintiles, lat_lon):
+        """
+        :param indptr: int64 array of shape (n_units + 1,), row o spans indptr[o]:indptr[o + 1]
+        :param indices: int array of destination codes, sorted within each row
+        :param counts: integer array of shape (nnz, n_races, n_quintiles)
+        :param states: array of unit names, position is the unit code. Queries select units by
+                       name, so names must be unique, for example "Washington County, OH"
+        :param state_ids: array of unit ids aligned with states
+        :param races: array of race names, position is the race code
+        :param quintiles: array of quintile values, position is the quintile code
+        :param lat_lon: float array of shape (n_units, 2) with latitude and longitude
+        :raises DataValidationError: when several units have the same name
+        """
+        names = pd.Series(states)
+        repeated = names[names.duplicated(keep=False)]
+        if len(repeated):
+            ids = pd.Series(state_ids)[repeated.index]
+            raise DataValidationError(['several units named {}, give them distinct names'.format(examples(
+                '{} (ids {})'.format(name, ', '.join(map(str, unit_ids)))
+                for name, unit_ids in ids.groupby(repeated.to_numpy(), sort=True).agg(list).items()))],
+                'unit data')
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+        self.states = states
+        self.state_ids = state_ids
+        self.races = races
+        self.quintiles = quintiles
+        self.lat_lon = lat_lon
+        self.state_index = {state: idx for idx, state in enumerate(states)}
+        self.id_order = np.argsort(state_ids, kind='stable')
+
+    def state_code(self, source):
+        return self.state_index[source]
+
+    def origin_flows(self, s):
+        """
+        :param s: origin unit code
+        :return: dense destination x race x quintile counts for the origin
+        """
+        start, stop = self.indptr[s], self.indptr[s + 1]
+        row = np.zeros((len(self.states),) + self.counts.shape[1:], dtype=self.counts.dtype)
+        row[self.indices[start:stop]] = self.counts[start:stop]
+        return row
+
+    def origin_distances(self, s):
+        """
+        :param s: origin unit code
+        :return: distance in miles from the origin to every unit
+        """
+        return distance_matrix(self.lat_lon[[s]], self.lat_lon)[0]
+
+    def origins(self):
+        """
+        :return: origin code of every stored pair, aligned with indices
+        """
+        return np.repeat(np.arange(len(self.states)), np.diff(self.indptr))
+
+
+def compress_pairs(o_codes, d_codes, n_units):
+    """
+    Method that finds the distinct origin/destination pairs in CSR order
+    :param o_codes: origin code of every record
+    :param d_codes: destination code of every record
+    :param n_units: number of units
+    :return: indptr, indices, and the pair position of every record
+    """
+    pairs, pair_codes = np.unique(o_codes.astype(np.int64) * n_units + d_codes, return_inverse=True)
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(pairs // n_units, minlength=n_units))])
+    return indptr, pairs % n_units, pair_codes
+
+
+def unit_codes(values, units, what):
+    codes = pd.Categorical(values, categories=units).codes
+    if (codes < 0).any():
+        missing = pd.unique(np.asarray(values)[codes < 0])
+        raise KeyError('No {} for {}'.format(what, ', '.join(map(str, missing[:10]))))
+    return codes
+
+
+def build_sparse_flows(base_df, units_df, origin_col='o_state_name', dest_col='d_state_name'):
+    """
+    Method that compresses a long migration dataframe into SparseFlows. Pairs of units
+    with no rows are not stored
+    :param base_df: df with origin_col, dest_col, race, quintile and n columns
+    :param units_df: df with one row per unit: unit (the values used in origin_col and
+                     dest_col), id, Latitude, Longitude and optionally a display name, unique
+                     across the units
+    :param origin_col: column of base_df with the origin unit
+    :param dest_col: column of base_df with the destination unit
+    :return: SparseFlows
+    :raises DataValidationError: when several units have the same name
+    """
+    units = units_df['unit'].to_numpy()
+    races = np.sort(base_df['race'].unique())
+    quintiles = np.sort(base_df['quintile'].unique())
+
+    o_codes = unit_codes(base_df[origin_col], units, 'unit')
+    d_codes = unit_codes(base_df[dest_col], units, 'unit')
+    r_codes = pd.Categorical(base_df['race'], categories=races).codes
+    q_codes = pd.Categorical(base_df['quintile'], categories=quintiles).codes
+
+    indptr, indices, pair_codes = compress_pairs(o_codes, d_codes, len(units))
+    counts = np.zeros((len(indices), len(races), len(quintiles)), dtype=np.int64)
+    np.add.at(counts, (pair_codes, r_codes, q_codes), base_df['n'].to_numpy())
+
+    names = units_df['name'] if 'name' in units_df else units_df['unit']
+    return SparseFlows(indptr, indices, counts, names.to_numpy().astype(object), units_df['id'].to_numpy(),
+                       races, quintiles, units_df[['Latitude', 'Longitude']].to_numpy(dtype=float))
+
+
+def rollup(flows, parent, parents_df):
+    """
+    Method that aggregates flows to a coarser geography, for example counties to commuting
+    zones or states, by summing the stored pairs of every parent pair
+    :param flows: SparseFlows
+    :param parent: array with the parent unit of every unit of flows, aligned with flows.states
+    :param parents_df: df describing the parent units, as units_df in build_sparse_flows
+    :return: SparseFlows
+    :raises DataValidationError: when several parent units have the same name
+    """
+    parents = parents_df['unit'].to_numpy()
+    parent_codes = unit_codes(parent, parents, 'parent unit')
+
+    indptr, indices, pair_codes = compress_pairs(parent_codes[flows.origins()], parent_codes[flows.indices],
+                                                 len(parents))
+    counts = np.zeros((len(indices),) + flows.counts.shape[1:], dtype=np.int64)
+    np.add.at(counts, pair_codes, flows.counts)
+
+    names = parents_df['name'] if 'name' in parents_df else parents_df['unit']
+    return SparseFlows(indptr, indices, counts, names.to_numpy().astype(object), parents_df['id'].to_numpy(),
+                       flows.races, flows.quintiles, parents_df[['Latitude', 'Longitude']].to_numpy(dtype=float))
+
+
+def write_sparse_bundle(flows, bundle_path):
+    """
+    Method that saves SparseFlows as a directory of .npy files
+    :param flows: SparseFlows
+    :param bundle_path: directory to write the bundle to
+    """
+    os.makedirs(bundle_path, exist_ok=True)
+    arrays = {'indptr': flows.indptr.astype(np.int64),
+              'indices': flows.indices.astype(np.int32),
+              'counts': flows.counts.astype(np.int32),
+              'states': flows.states.astype(str),
+              'state_ids': flows.state_ids,
+              'races': flows.races.astype(str),
+              'quintiles': flows.quintiles.astype(np.int32),
+              'lat_lon': flows.lat_lon}
+    for name in SPARSE_BUNDLE_ARRAYS:
+        path = os.path.join(bundle_path, name + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, arrays[name], allow_pickle=False)
+        os.replace(path + '.tmp', path)
+
+
+def read_sparse_bundle(bundle_path):
+    """
+    Method that loads a bundle written by write_sparse_bundle, memory-mapping the pair arrays
+    :param bundle_path: bundle directory
+    :return: SparseFlows
+    """
+    def load(name, mmap_mode=None):
+        return np.load(os.path.join(bundle_path, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+
+    return SparseFlows(load('indptr'), load('indices', mmap_mode='r'), load('counts', mmap_mode='r'),
+                       load('states').astype(object), load('state_ids'), load('races').astype(object),
+                       load('quintiles'), load('lat_lon'))
@@ -1,247 +1,277 @@
-import altair as alt
-import pandas as pd
-import streamlit as st
-from vega_datasets import data
-
-from usmap import migration_data, miles_moved_race, miles_moved_race_q, global_average_distance, race_data
-
-st.title("How does race and parental income influence how far young adults move from home for their first job?")
-st.write("In this data science project we are interested in analyzing how race and the parental income of a young adult\
-    influence how far they move for their first job. Here we use the Migration Patterns data whose sample includes \
-    all children in the Census Numerical Identification Database (Numident) of Social Security Number holders who are \
-    born in the U.S. between 1984-92. Child race is measured using information from the 2010 Decennial Census and American \
-    Community Survey (ACS). In this dataset we have 5 unique values for race- Asian, Black, Hispanic, White, and Other. \
-    Location at age 16 and 26 is assigned using Census, tax, and HUD information. \
-    Parental income is measured as a 5-year average of family income when the children are aged 14-18 based on the \
-    tax form 1040 of the parent who claims them as a dependent. The values for these quintiles are integers from 1 to 5 \
-    where “1” is the poorest parental income quintile and 5 is richest parental income quintile.")
-
-st.write('The US map shows the states young adults migrated to from a selected state highlighted in orange. It is \
-    followed by a bar chart which shows the Top 10 states the population moved to from that state. Selecting a state on the map\
-    highlights the corresponding bar in the bar chart and vice versa.')
-
-@st.cache  # add caching so we load the data only once
-def load_data():
-    """
-    Method to load relevant files:
-    - state_to_state_migration.csv: Contains number of people who moved from one state to other states
-                                    broken down by race and income quintiles
-    - state_lat_lon.csv: Contains states and their latitude, longitudes
-    :return:
-        - base_df: df from state_to_state.csv
-        - lat_lon_df: df from state_lat_lon.csv
-    """
-    base_df = pd.read_csv('state_to_state_migration.csv')
-    base_df.drop(['Unnamed: 0'], axis=1, inplace=True)
-
-    lat_lon_df = pd.read_csv('state_lat_lon.csv')
-    lat_lon_df = lat_lon_df.sort_values(by=['State']).reset_index(drop=True)
-
-    return base_df, lat_lon_df
-
-# Method call to load the required data
-base_df, lat_lon_df = load_data()
-
-# Drop down to list the available states
-states_options = lat_lon_df['State']
-
-source = st.selectbox(
-    'Where did young adults move to?',
-    states_options)
-
-migration_df = migration_data(base_df, lat_lon_df, source)
-
-click = alt.selection_multi(fields=['d_state_name'])
-
-# Chart for highlighting the selection
-states = alt.topo_feature(data.us_10m.url, feature='states')
-selection_chart = alt.Chart(states, width=2000, height=15) \
-    .mark_geoshape().encode(
-    tooltip=[alt.Tooltip('n:Q', title='Population staying back')],
-    color=alt.Color('n:Q', scale=alt.Scale(scheme="yelloworangered"), legend=None)
-).transform_lookup(
-    lookup='id',
-    from_=alt.LookupData(migration_df[migration_df['d_state_name'] == source], 'd_state_id', ['n'])
-).properties(
-    width=600,
-    height=500
-).project(
-    type='albersUsa'
-)
-
-# Adding our data to the chart
-#https://altair-viz.github.io/gallery/choropleth.html
-migration_chart = alt.Chart(states, width=2000, height=15,
-                            title='Choropleth showing the number of people migrating from {}'.format(source)) \
-    .mark_geoshape(
-    stroke='lightgray'
-).encode(
-    tooltip=[alt.Tooltip('d_state_name:O', title='State'),
-             alt.Tooltip('n:Q', title='# moved here')],
-    color=alt.Color('n:Q',
-                    title="Population migrating"),
-    opacity=alt.condition(click, alt.value(1), alt.value(0.2))
-).transform_lookup(
-    lookup='id',
-    from_=alt.LookupData(migration_df[migration_df['d_state_name'] != source], 'd_state_id',
-                         ['n', 'd_state_name'])
-).properties(
-    width=600,
-    height=500
-).project(
-    type='albersUsa'
-).add_selection(click)
-
-usmap = alt.layer(selection_chart,
-                  migration_chart).resolve_scale(color='independent')
-
-#https://stackoverflow.com/questions/63751130/altair-choropleth-map-color-highlight-based-on-line-chart-selection
-popular_state_bar = alt.Chart(
-                        migration_df[migration_df['d_state_name'] != source].nlargest(10, 'n'),
-                        title='Top 10 states young adults migrated to from {}'.format(source),
-                        width=600).\
-                        mark_bar().encode(
-                            x=alt.X('n', title="Population migrating"),
-                            opacity=alt.condition(click, alt.value(1), alt.value(0.2)),
-                            color=alt.Color('n:Q', legend=None),
-                            y=alt.Y('d_state_name', sort='-x', title="Destination States"),
-                            tooltip=[alt.Tooltip('n:Q', title="# of people")]
-                    ).add_selection(click)
-
-combo = alt.vconcat(usmap, popular_state_bar, center=True)
-combo
-
-race_df, quintile_df = race_data(base_df, source)
-max_race =  max(race_df['race'])
-max_quin_pop = max(quintile_df[quintile_df['race'] == max_race]['n'])
-max_quin = quintile_df.loc[quintile_df.n == max_quin_pop, 'quintile'].values[0]
-
-st.subheader("Influence of Race and Parental Income on the number of young adults migrating")
-st.write('Let us now analyze the influence of race in the movement of population. For the state of {},\
-    the bar chart shows the number of people who moved out of the state by each race. The quintile chart shows the distribution \
-    of population migrated in each parental income quintile. According to this dataset, Quintile **1** is the poorest \
-    parental income quintile and **5** is richest parental income quintile'.format(source))
-    
-st.write('In state of **{}**,'.format(source))
-st.markdown('- Young adults belonging to the **{}** race move the maximum. '.format(max_race))
-st.markdown('- Within the race, the young adults belonging to Quintile **{}** move the most.'.format(max_quin))
-   
-st.write('Additionally, on clicking the bar corresponding to a particular race, the pie chart shows the number \
-    of people who moved in that race by the parental income quintile.')
-
-st.subheader('Insights:')
-st.write('From analyzing the charts for a majority of the states, it was evident that the White young adults \
-    moved the maximum in numbers away from their homes. Within this, it was interesting to note that young adults \
-    belonging to Quintile 5 moved the most. In contrast, the Black and Hispanic young adults belonging to Quintile 1 \
-    moved the most.')
-brush = alt.selection_single(encodings=["y"], init={'race': max_race}, empty='none')
-
-race_barchart = alt.Chart(race_df, 
-title='Population migration from {} by Race'.format(source),
-    width=420).mark_bar().encode(
-    x=alt.X('n', title="Population migrating"),
-    y=alt.Y('race', title="Race"),
-    opacity = alt.condition(brush, alt.value(1), alt.value(0.8)),
-    tooltip=[alt.Tooltip('n:Q', title="# of people")]
-).add_selection(brush)
-
-race_quintile_chart = alt.Chart(quintile_df, 
-    title = 'Population migrating by selected race').encode(
-    theta=alt.Theta("n:Q", stack=True), color=alt.Color("quintile:N"),
-    tooltip=[alt.Tooltip('quintile:N', title='Quintile')]
-).transform_filter(brush)
-
-pie = race_quintile_chart.mark_arc(outerRadius=100, innerRadius = 60)
-text = race_quintile_chart.mark_text(radius=125, size=16).encode(
-    text="n:Q",
-    opacity=alt.condition(brush, alt.value(1), alt.value(0)))
-
-race_quintile_chart_comb = pie + text
-
-race_charts = alt.hconcat(race_barchart, race_quintile_chart_comb, center=True)
-race_charts
-
-
-miles_moved_race_df = miles_moved_race(base_df, lat_lon_df, source)
-miles_moved_race_q_df = miles_moved_race_q(base_df, lat_lon_df, source)
-
-max_miles_dist =  max(miles_moved_race_df['Distance'])
-max_miles_race = max(miles_moved_race_df[miles_moved_race_df['Distance'] == max_miles_dist]['Race'])
-
-max_miles_quin_dist = max(miles_moved_race_q_df.loc[miles_moved_race_q_df.Race == max_miles_race, 'Distance'])
-max_miles_quin = miles_moved_race_q_df.loc[miles_moved_race_q_df.Distance == max_miles_quin_dist, 'Quintile'].values[0]
-
-st.subheader("Influence of Race and Parental Income on the distance young adults migrate")
-st.write('In state of **{}**,'.format(source))
-st.markdown('- Young adults belonging to the **{}** race move the farthest from their homes. '.format(max_miles_race))
-st.markdown('- Within the race, the young adults belonging to Quintile **{}** move the most.'.format(max_miles_quin))
-   
-st.write('Additionally, on clicking the bar corresponding to a particular race, the bar chart shows the number \
-    of people who moved in that race by the parental income quintile. The bar chart below also shows the average \
-    distance moved in miles as compared to the national average for the selected race.')
-
-
-st.subheader('Insights:')
-st.write('From analyzing the charts for a majority of the states, it was evident that on average Asian young adults moved the \
-    farthest away from their homes. In addition on observing the quintiles we noticed that young adults belonging to \
-    Quintile 4 or 5 moved the farthest distances. However, this cannot be generalized, the distance moved by different races \
-    depends on the state as well.')
-
-race_brush = alt.selection_single(encodings=['y'])
-distance_moved_race_bar = alt.Chart(
-                                miles_moved_race_df,
-                                height=100,
-                                title='Average distance moved by each race from {}'.format(source))\
-                                .mark_bar().encode(
-                                    x=alt.X('Distance', title='Distance moved in miles'),
-                                    y=alt.Y('Race', title="Race"),
-                                    opacity=alt.condition(race_brush, alt.value(1), alt.value(0.2)),
-                                    tooltip=[alt.Tooltip('Distance:Q', title='Distance moved')]
-                                ).add_selection(race_brush)
-
-distance_moved_race_q_bar = alt.Chart(
-                                miles_moved_race_q_df,
-                                width=180,
-                                title='Average distance moved by each quintile from {}'.format(source))\
-                                .mark_bar().encode(
-                                    y=alt.Y('Distance:Q', title='Distance moved in miles'),
-                                    x=alt.X('Quintile:O', title="Income Quantile"),
-                                    tooltip=[alt.Tooltip('Distance:Q', title='Distance moved')],
-                                    color='Race'
-                                ).transform_filter(race_brush)
-
-avg_distance = global_average_distance(base_df, lat_lon_df)
-
-#Referred from 
-#https://altair-viz.github.io/gallery/isotype_emoji.html
-#https://medium.com/dataexplorations/how-to-add-emojis-to-an-altair-chart-f9bc02da3a4b
-miles_moved_race_df['icon'] = ['👨', '👨', '👨', '👨', '👨']
-avg_df = pd.DataFrame({'Name': 'National Average', 'Value': avg_distance, 'icon': '🇺🇸'}, index=[0])
-
-race_dist = alt.Chart(
-    miles_moved_race_df,
-    title="Distance moved by selected race vs National Average",
-    height=75)\
-    .mark_text(filled=True, size=25, baseline='middle').encode(
-        x=alt.X('Distance:Q', title="Distance moved in miles", axis=alt.Axis(grid=False),
-                scale=alt.Scale(domain=[0, miles_moved_race_df['Distance'].max()+200])),
-        text=alt.Text('icon'),
-        tooltip=[alt.Tooltip('Distance:Q', title='Distance')]
-    ).transform_filter(race_brush)
-
-avg_dist = alt.Chart(
-    avg_df,
-    height=75)\
-    .mark_text(filled=True, size=25, baseline='middle').encode(
-        x=alt.X('Value:Q', scale=alt.Scale(domain=[0, miles_moved_race_df['Distance'].max()+200])),
-        text=alt.Text('icon'),
-        tooltip=[alt.Tooltip('Value:Q', title='Distance')]
-    )
-
-line = alt.Chart(pd.DataFrame({'y': [1]}))\
-    .mark_rule().encode(y=alt.Y('y', axis=alt.Axis(tickSize=0, labelFontSize=0), title=None))
-
-dist_plot = race_dist + avg_dist + line
-combo2 = alt.hconcat(distance_moved_race_bar, distance_moved_race_q_bar, center=True)
-cc = alt.vconcat(combo2, dist_plot)
-cc
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from charts import chart_specs, distance_spec, inbound_spec, map_spec, race_spec, trend_spec
+from instrumentation import Profiler, finish_rerun, in_rerun, log_to_stderr, mark, section, start_rerun
+from usmap import COHORTS_MANIFEST, STATE_QUERIES, QueryCache, cohort_comparison, data_version, distance_intervals, \
+    flow_ranking, migration_data, miles_moved_race, miles_moved_race_q, national_statistics, race_data, read_cohorts
+
+LAT_LON_FILE = 'state_lat_lon.csv'
+# Set WARM_QUERY_CACHE=1 to compute every state's results when the server loads the data
+WARM_QUERY_CACHE = os.environ.get('WARM_QUERY_CACHE') == '1'
+# Set PRERENDER_CHARTS=1 to cache the Vega-Lite specs of every state instead of building them on each rerun
+PRERENDER_CHARTS = os.environ.get('PRERENDER_CHARTS') == '1'
+# Set INSTRUMENT_APP=1 to log the timing breakdown of every rerun as a json line
+INSTRUMENT_APP = os.environ.get('INSTRUMENT_APP') == '1'
+
+# Hidden debug options: ?debug=1 shows the timings in the sidebar, ?profile=pyinstrument also
+# profiles the rerun, with cProfile for any other value or when pyinstrument is not installed
+query_params = st.experimental_get_query_params()
+debug = query_params.get('debug', ['0'])[0] == '1'
+profile_kind = query_params.get('profile', [None])[0]
+if INSTRUMENT_APP:
+    log_to_stderr()
+if INSTRUMENT_APP or debug or profile_kind:
+    start_rerun()
+profiler = Profiler(profile_kind) if profile_kind else None
+if profiler:
+    profiler.start()
+
+st.title("How does race and parental income influence how far young adults move from home for their first job?")
+st.write("In this data science project we are interested in analyzing how race and the parental income of a young adult\
+    influence how far they move for their first job. Here we use the Migration Patterns data whose sample includes \
+    all children in the Census Numerical Identification Database (Numident) of Social Security Number holders who are \
+    born in the U.S. between 1984-92. Child race is measured using information from the 2010 Decennial Census and American \
+    Community Survey (ACS). In this dataset we have 5 unique values for race- Asian, Black, Hispanic, White, and Other. \
+    Location at age 16 and 26 is assigned using Census, tax, and HUD information. \
+    Parental income is measured as a 5-year average of family income when the children are aged 14-18 based on the \
+    tax form 1040 of the parent who claims them as a dependent. The values for these quintiles are integers from 1 to 5 \
+    where “1” is the poorest parental income quintile and 5 is richest parental income quintile.")
+
+st.write('The US map shows the states young adults migrated to from a selected state highlighted in orange. It is \
+    followed by a bar chart which shows the Top 10 states the population moved to from that state. Selecting a state on the map\
+    highlights the corresponding bar in the bar chart and vice versa.')
+
+@st.experimental_singleton
+def load_cohorts(version):
+    """
+    Cohorts listed in cohorts.json, shared by every session
+    :param version: content hash of cohorts.json, used as the cache key
+    :return: usmap.CohortFlows
+    """
+    return read_cohorts(COHORTS_MANIFEST, LAT_LON_FILE)
+
+
+def load_data(cohort):
+    """
+    Method to load relevant files:
+    - the cohort's state_to_state_migration csv: Contains number of people who moved from one state to other states
+                                                 broken down by race and income quintiles
+    - state_lat_lon.csv: Contains states and their latitude, longitudes
+    The migration counts are memory-mapped from the bundle data_agg.py writes next to the csv,
+    the csv is only parsed when the bundle is missing or stale. Each cohort is loaded once per
+    process when it is first selected, and again when its files change
+    :param cohort: cohort name from cohorts.json
+    :return:
+        - flows: FlowTensor of the cohort indexed by origin, destination, race and quintile
+    """
+    return load_cohorts(data_version(COHORTS_MANIFEST)).flows(cohort)
+
+
+@st.experimental_singleton
+def load_national_statistics(cohort, version):
+    """
+    National average distances over all origins. They do not depend on the selected state,
+    so they are computed once per process and only recomputed when the data files change
+    :param cohort: cohort name
+    :param version: content hash of the cohort's data files, used as the cache key
+    :return: dict from usmap.national_statistics
+    """
+    return national_statistics(load_data(cohort))
+
+
+@st.experimental_singleton
+def load_query_cache():
+    """
+    LRU cache of the per-state query results, shared by every session
+    :return: usmap.QueryCache
+    """
+    return QueryCache()
+
+
+@st.experimental_singleton
+def warm_query_cache(cohort, version):
+    """
+    Fills the query cache with all states of the cohort, once per data version
+    :param cohort: cohort name
+    :param version: content hash of the cohort's data files, used as the cache key
+    """
+    queries = STATE_QUERIES + (chart_specs,) if PRERENDER_CHARTS else STATE_QUERIES
+    load_query_cache().warm_up(load_data(cohort), version, queries)
+    return True
+
+@st.experimental_singleton
+def section_executor():
+    """
+    Threads computing the charts of the lower sections while the page above them is sent
+    :return: ThreadPoolExecutor
+    """
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix='page-sections')
+
+
+def race_charts_spec(source, max_race):
+    """
+    Spec of the race and quintile charts of the selected state
+    """
+    if PRERENDER_CHARTS:
+        return query_cache.get(flows, data_hash, chart_specs, source)['race']
+    race_df, quintile_df = query_cache.get(flows, data_hash, race_data, source)
+    return race_spec(race_df, quintile_df, source, max_race)
+
+
+def distance_charts_spec(source, national_race_df, show_intervals=False):
+    """
+    Spec of the distance charts of the selected state, with error bars when show_intervals is set
+    """
+    if show_intervals:
+        return distance_spec(*query_cache.get(flows, data_hash, distance_intervals, source), national_race_df, source)
+    if PRERENDER_CHARTS:
+        return query_cache.get(flows, data_hash, chart_specs, source)['distance']
+    return distance_spec(query_cache.get(flows, data_hash, miles_moved_race, source),
+                         query_cache.get(flows, data_hash, miles_moved_race_q, source), national_race_df, source)
+
+# Method call to load the required data
+with section('load_data'):
+    cohorts = load_cohorts(data_version(COHORTS_MANIFEST))
+    # The cohort selector is only shown when cohorts.json lists more than one
+    cohort = cohorts.names[0]
+    if len(cohorts.names) > 1:
+        cohort = st.selectbox('Which cohort of young adults?', cohorts.names, format_func=cohorts.label)
+    data_hash = cohorts.version(cohort)
+    flows = load_data(cohort)
+query_cache = load_query_cache()
+if WARM_QUERY_CACHE:
+    with section('warm_query_cache'):
+        warm_query_cache(cohort, data_hash)
+cache_hits, cache_misses = query_cache.hits, query_cache.misses
+
+# Drop down to list the available states
+states_options = flows.states
+
+source = st.selectbox(
+    'Where did young adults move to?',
+    states_options)
+
+# The map is built and sent first. The charts further down are computed in background
+# threads once it is sent, and fill the placeholders left for them when they are ready
+# Top destinations and origins, and the dominant and farthest moving race and quintile,
+# are looked up in rankings precomputed for every state
+ranking = flow_ranking(flows)
+if PRERENDER_CHARTS:
+    map_chart = query_cache.get(flows, data_hash, chart_specs, source)['map']
+else:
+    map_chart = map_spec(query_cache.get(flows, data_hash, migration_data, source),
+                         ranking.destination_ranks(source), source)
+
+with section('send_map'):
+    st.vega_lite_chart(map_chart)
+mark('first_chart')
+
+st.subheader('Where do young adults moving to {} come from?'.format(source))
+race_column, quintile_column = st.columns(2)
+inbound_race = race_column.selectbox('Race', ['All races'] + list(flows.races))
+inbound_quintile = quintile_column.selectbox('Parental income quintile', ['All quintiles'] + list(flows.quintiles))
+inbound_group = 'young adults'
+if inbound_race == 'All races':
+    inbound_race = None
+else:
+    inbound_group = '{} young adults'.format(inbound_race)
+if inbound_quintile == 'All quintiles':
+    inbound_quintile = None
+else:
+    inbound_group += ' of Quintile {}'.format(inbound_quintile)
+with section('send_inbound_chart'):
+    st.vega_lite_chart(inbound_spec(ranking.top_origins(source, 10, inbound_race, inbound_quintile),
+                                    source, inbound_group))
+
+max_race = ranking.dominant_race(source)
+max_quin = ranking.dominant_quintile(source, max_race)
+
+race_charts = section_executor().submit(in_rerun(race_charts_spec), source, max_race)
+
+st.subheader("Influence of Race and Parental Income on the number of young adults migrating")
+st.write('Let us now analyze the influence of race in the movement of population. For the state of {},\
+    the bar chart shows the number of people who moved out of the state by each race. The quintile chart shows the distribution \
+    of population migrated in each parental income quintile. According to this dataset, Quintile **1** is the poorest \
+    parental income quintile and **5** is richest parental income quintile'.format(source))
+    
+st.write('In state of **{}**,'.format(source))
+st.markdown('- Young adults belonging to the **{}** race move the maximum. '.format(max_race))
+st.markdown('- Within the race, the young adults belonging to Quintile **{}** move the most.'.format(max_quin))
+   
+st.write('Additionally, on clicking the bar corresponding to a particular race, the pie chart shows the number \
+    of people who moved in that race by the parental income quintile.')
+
+st.subheader('Insights:')
+st.write('From analyzing the charts for a majority of the states, it was evident that the White young adults \
+    moved the maximum in numbers away from their homes. Within this, it was interesting to note that young adults \
+    belonging to Quintile 5 moved the most. In contrast, the Black and Hispanic young adults belonging to Quintile 1 \
+    moved the most.')
+race_charts_slot = st.empty()
+
+
+st.subheader("Influence of Race and Parental Income on the distance young adults migrate")
+show_intervals = st.checkbox('Show 95% confidence intervals',
+                             help='Bootstrap intervals of the average distances. They are wide where few people '
+                                  'of a race or quintile left the state, and the ranking there may be down to chance')
+
+# Streamlit's caches can only show their spinner from the script thread, so the national
+# statistics are looked up here
+distance_charts = section_executor().submit(in_rerun(distance_charts_spec), source,
+                                            load_national_statistics(cohort, data_hash)['race'], show_intervals)
+
+max_miles_race = ranking.farthest_race(source)
+max_miles_quin = ranking.farthest_quintile(source, max_miles_race)
+
+st.write('In state of **{}**,'.format(source))
+st.markdown('- Young adults belonging to the **{}** race move the farthest from their homes. '.format(max_miles_race))
+st.markdown('- Within the race, the young adults belonging to Quintile **{}** move the most.'.format(max_miles_quin))
+if show_intervals:
+    miles_moved_race_df, _ = query_cache.get(flows, data_hash, distance_intervals, source)
+    runner_up = miles_moved_race_df[miles_moved_race_df['Race'] != max_miles_race].nlargest(1, 'Distance').iloc[0]
+    if miles_moved_race_df.loc[miles_moved_race_df['Race'] == max_miles_race, 'Lower'].iloc[0] <= runner_up['Upper']:
+        st.markdown('- The confidence intervals of **{}** and **{}** young adults overlap, so they may well move '
+                    'about as far as each other.'.format(max_miles_race, runner_up['Race']))
+   
+st.write('Additionally, on clicking the bar corresponding to a particular race, the bar chart shows the number \
+    of people who moved in that race by the parental income quintile. The bar chart below also shows the average \
+    distance moved in miles as compared to the national average for the selected race.')
+
+
+st.subheader('Insights:')
+st.write('From analyzing the charts for a majority of the states, it was evident that on average Asian young adults moved the \
+    farthest away from their homes. In addition on observing the quintiles we noticed that young adults belonging to \
+    Quintile 4 or 5 moved the farthest distances. However, this cannot be generalized, the distance moved by different races \
+    depends on the state as well.')
+distance_charts_slot = st.empty()
+
+with section('send_race_charts'):
+    race_charts_slot.vega_lite_chart(race_charts.result())
+
+with section('send_distance_charts'):
+    distance_charts_slot.vega_lite_chart(distance_charts.result())
+
+if len(cohorts.names) > 1:
+    comparison = query_cache.get(cohorts, cohorts.version(), cohort_comparison, source)
+    st.subheader('Trends across cohorts')
+    st.write('The line chart shows how far young adults of every race moved from {} in each cohort, and the bar chart \
+        the destinations whose number of young adults arriving from {} changed the most in the selected cohort \
+        compared to {}.'.format(source, source, cohorts.label(cohorts.names[0])))
+    with section('send_trend_charts'):
+        st.vega_lite_chart(trend_spec(comparison, source, cohort, cohorts.names))
+
+profile_report = profiler.stop() if profiler else None
+rerun = finish_rerun(source=source, cohort=cohort, data_version=data_hash,
+                     cache_hits=query_cache.hits - cache_hits, cache_misses=query_cache.misses - cache_misses)
+if debug and rerun:
+    with st.sidebar:
+        st.subheader('Rerun timings')
+        st.write('Total: {} ms, first chart sent after {} ms'.format(rerun['total_ms'], rerun.get('first_chart_ms')))
+        st.table({'ms': rerun['timings_ms'], 'calls': rerun['calls']})
+        lookups = query_cache.hits + query_cache.misses
+        st.write('Query cache: {} hits, {} misses this rerun; {:.0%} hit rate over {} lookups since start'.format(
+            rerun['cache_hits'], rerun['cache_misses'], query_cache.hits / lookups if lookups else 0, lookups))
+        if profile_report:
+            st.text(profile_report)
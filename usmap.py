@@ -1,177 +1,1193 @@
-import pandas as pd
-import haversine as hs
-from haversine import Unit
-import numpy as np
-
-
-def migration_data(base_df, lat_lon_df, source):
-    """
-    Method that subsets the main dataframe and produces
-    a dataframe for the selected state on the map. Along
-    with that it appends the corresponding latitutde and
-    longitude values for all the states in the resulting
-    df
-    :param base_df: df for migrations from all states to all states
-    :param lat_lon_df: df for latitude and longitude values for each state
-    :param source: selected state
-    :return: migration_df
-    """
-    filter = (base_df['o_state_name'] == source)
-    migration_df = base_df[filter]
-    migration_df.reset_index(drop=True, inplace=True)
-
-    migration_df = migration_df.groupby(['o_state_id', 'o_state_name',
-                                         'd_state_id', 'd_state_name'])['n']\
-                               .sum()\
-                               .reset_index()\
-                               .drop(['o_state_id', 'o_state_name'], axis=1)
-
-    migration_df = pd.concat([migration_df, lat_lon_df], axis=1)
-
-    return migration_df
-
-
-def calc_distance(loc1, loc2):
-    """
-    Method that calculates distance from one point to another, where each
-    point is a tuple
-    :param loc1: tuple of lat, lon
-    :param loc2: tuple of lat, lon
-    :return: distance in miles between the two points
-    """
-    return hs.haversine(loc1, loc2, unit=Unit.MILES)
-
-
-def miles_moved_race(base_df, lat_lon_df, source):
-    """
-    Function that takes the base dataframe and source, and calculates the weighted average of the distance
-    moved by each race
-    :param base_df: base dataframe
-    :param lat_lon_df: dataframe containing lat and lon for each state
-    :param source: selected state
-    :return: df with average distance moved for each race
-    """
-    filter = (base_df['o_state_name'] == source) & (base_df['d_state_name'] != source)
-    distance_df = base_df[filter].copy()
-    distance_df.reset_index(drop=True, inplace=True)
-    distance_df.drop(['o_state_id', 'o_state_name', 'd_state_id'], axis=1, inplace=True)
-
-    counts_df = distance_df.groupby(['d_state_name', 'race'])['n'].agg('sum')\
-                            .reset_index()
-    counts_df = counts_df.join(lat_lon_df.set_index('State'), on='d_state_name')
-
-    # Calculating miles moved
-    race_groups = counts_df.groupby(['race'])
-    race_distance_dict = {'Race': [],
-                          'Distance': []}
-    source_lat_lon = (lat_lon_df[lat_lon_df['State'] == source]['Latitude'].item(),
-                      lat_lon_df[lat_lon_df['State'] == source]['Longitude'].item())
-
-    for race in counts_df['race'].unique():
-        race_df = race_groups.get_group(race)
-
-        numbers_array = np.abs(np.array(list(race_df['n'])).reshape((50,)))
-        lat_list = list(race_df['Latitude'])
-        lon_list = list(race_df['Longitude'])
-
-        distances = np.zeros(50)
-        for idx, dest_lat_lon in enumerate(zip(lat_list, lon_list)):
-            distances[idx] = calc_distance(source_lat_lon, dest_lat_lon)
-
-        weighted_distance = distances @ numbers_array
-        race_distance_dict['Race'].append(race)
-        race_distance_dict['Distance'].append(np.round(weighted_distance/np.sum(numbers_array, axis=0), 2))
-
-    return pd.DataFrame.from_dict(race_distance_dict, orient='columns')
-
-
-def miles_moved_race_q(base_df, lat_lon_df, source):
-    """
-        Function that takes the base dataframe and source, and calculates the weighted average of the distance
-        moved by each race and quintile
-        :param base_df: base dataframe
-        :param lat_lon_df: dataframe containing lat and lon for each state
-        :param source: selected state
-        :return: df with average distance moved for each race
-    """
-    filter = (base_df['o_state_name'] == source) & (base_df['d_state_name'] != source)
-    distance_df = base_df[filter].copy()
-    distance_df.reset_index(drop=True, inplace=True)
-    distance_df.drop(['o_state_id', 'o_state_name', 'd_state_id'], axis=1, inplace=True)
-
-    distance_df = distance_df.join(lat_lon_df.set_index('State'), on='d_state_name')
-
-    # Calculating miles moved
-    race_groups = distance_df.groupby(['race'])
-    race_distance_dict = {'Race': [],
-                          'Quintile':[],
-                          'Distance':[]}
-    source_lat_lon = (lat_lon_df[lat_lon_df['State'] == source]['Latitude'].item(),
-                      lat_lon_df[lat_lon_df['State'] == source]['Longitude'].item())
-
-    for race in distance_df['race'].unique():
-        quintile_groups = race_groups.get_group(race).groupby(['quintile'])
-
-        for i in range(1, 6):
-            q_df = quintile_groups.get_group(i)
-
-            numbers_array = np.abs(np.array(list(q_df['n'])).reshape((50,)))
-            lat_list = list(q_df['Latitude'])
-            lon_list = list(q_df['Longitude'])
-
-            distances = np.zeros(50)
-            for idx, dest_lat_lon in enumerate(zip(lat_list, lon_list)):
-                distances[idx] = calc_distance(source_lat_lon, dest_lat_lon)
-
-            weighted_distance = distances @ numbers_array
-            race_distance_dict['Race'].append(race)
-            race_distance_dict['Quintile'].append(i)
-            race_distance_dict['Distance'].append(np.round(weighted_distance/np.sum(numbers_array, axis=0), 2))
-
-    return pd.DataFrame.from_dict(race_distance_dict, orient='columns')
-
-
-def global_average_distance(base_df, lat_lon_df):
-    '''
-    For each state, using it as the source, we extract migration_df. As we have the source, 
-    we use the latitude and longitude to calculate the distance betweent the states weighted 
-    by the number of people moved. 
-    '''
-    distances_state_wise = []
-
-    for state in lat_lon_df['State'].unique():
-        migration_df = migration_data(base_df, lat_lon_df, state)
-        source_lat_lon = (lat_lon_df[lat_lon_df['State'] == state]['Latitude'].item(),
-                          lat_lon_df[lat_lon_df['State'] == state]['Longitude'].item())
-
-        numbers_array = np.abs(np.array(list(migration_df['n'])).reshape((51,)))
-        lat_list = list(migration_df['Latitude'])
-        lon_list = list(migration_df['Longitude'])
-
-        distances = np.zeros(51)
-        for idx, dest_lat_lon in enumerate(zip(lat_list, lon_list)):
-            distances[idx] = calc_distance(source_lat_lon, dest_lat_lon)
-
-        weighted_distance = distances @ numbers_array
-        distances_state_wise.append(np.round(weighted_distance/np.sum(numbers_array, axis=0), 2))
-    return np.round(np.mean(np.array(distances_state_wise)), 2)
-
-def race_data(base_df, source):
-    filter = (base_df['o_state_name'] == source)
-    race_df = base_df[filter]
-    race_df.reset_index(drop=True, inplace=True)
-    race_df = race_df[race_df['d_state_name'] != source]
-    race_df = race_df.drop(['o_state_id', 'd_state_id', 'quintile'], axis=1)
-    race_df = race_df.groupby(['o_state_name', 'race'])['n']\
-                               .sum()\
-                               .reset_index()
-
-    quintile_df = base_df[filter]
-    quintile_df.reset_index(drop=True, inplace=True)
-    quintile_df = quintile_df[quintile_df['d_state_name'] != source]
-    quintile_df = quintile_df.drop(['o_state_id', 'd_state_id', 'd_state_name'], axis=1)
-    quintile_df = quintile_df.groupby(['o_state_name', 'race', 'quintile'])['n']\
-                               .sum()\
-                               .reset_index()
-
-    return race_df, quintile_df
+import functools
+import hashlib
+import json
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from statistics import NormalDist
+
+import pandas as pd
+import numpy as np
+
+from instrumentation import timed
+
+# Mean earth radius used by the haversine package, in miles
+EARTH_RADIUS_MILES = 6371.0088 * 0.621371192
+
+
+class FlowTensor:
+    """
+    Dense representation of state_to_state_migration.csv. The counts are held in
+    a single array indexed by (origin, destination, race, quintile), where states,
+    races and quintiles are replaced by integer codes into the lookup arrays below.
+    """
+
+    def __init__(self, flows, states, state_ids, races, quintiles, lat_lon):
+        """
+        :param flows: integer array (int64, or memory-mapped int32 when read from a bundle) of shape (n_states, n_states, n_races, n_quintiles)
+        :param states: array of state names, position is the state code
+        :param state_ids: array of FIPS ids aligned with states
+        :param races: array of race names, position is the race code
+        :param quintiles: array of quintile values, position is the quintile code
+        :param lat_lon: float array of shape (n_states, 2) with latitude and longitude
+        """
+        self.flows = flows
+        self.states = states
+        self.state_ids = state_ids
+        self.races = races
+        self.quintiles = quintiles
+        self.lat_lon = lat_lon
+        self.distances = distance_matrix(lat_lon)
+        self.state_index = {state: idx for idx, state in enumerate(states)}
+        # Destination order used by the dataframes handed to the charts (FIPS id order)
+        self.id_order = np.argsort(state_ids, kind='stable')
+        # Per-origin average distances (see origin_averages), filled in when read from a bundle
+        # or when national_statistics first computes them
+        self.origin_averages = None
+        # FlowRanking built by flow_ranking on first use
+        self.ranking = None
+        # Summary of validate_migration when the tensor was built from the csv, see build_flow_tensor
+        self.validation = None
+
+    def state_code(self, source):
+        return self.state_index[source]
+
+    def origin_flows(self, s):
+        """
+        :param s: origin state code
+        :return: destination x race x quintile counts for the origin
+        """
+        return self.flows[s]
+
+    def origin_distances(self, s):
+        """
+        :param s: origin state code
+        :return: distance in miles from the origin to every destination
+        """
+        return self.distances[s]
+
+
+# Columns of state_to_state_migration.csv and whether they hold integers or strings
+MIGRATION_COLUMNS = {'o_state_id': 'integer', 'o_state_name': 'string',
+                     'd_state_id': 'integer', 'd_state_name': 'string',
+                     'race': 'string', 'quintile': 'integer', 'n': 'integer'}
+LAT_LON_COLUMNS = {'State': 'string', 'Latitude': 'number', 'Longitude': 'number'}
+# Latitude and longitude ranges that hold every state, Hawaii and Alaska included
+US_BOUNDS = ((18.0, 72.0), (-180.0, -66.0))
+# Recorded in the bundle metadata, bundles written before the data was validated are rebuilt
+VALIDATION_VERSION = 1
+
+
+class DataValidationError(ValueError):
+    """
+    Raised when the migration or latitude/longitude data does not have the layout the
+    queries rely on. Lists every problem found rather than only the first
+    """
+
+    def __init__(self, problems, source='migration data'):
+        self.problems = list(problems)
+        super().__init__('Invalid {}:\n'.format(source) + '\n'.join('  - ' + problem for problem in self.problems))
+
+
+def examples(values, limit=5):
+    """
+    Method that formats the first few offending values of a check for an error message
+    :param values: sequence of values
+    :param limit: number of values shown
+    :return: string such as "3, 7, 12 and 40 more"
+    """
+    values = list(values)
+    shown = ', '.join(map(str, values[:limit]))
+    return shown if len(values) <= limit else '{} and {} more'.format(shown, len(values) - limit)
+
+
+def column_problems(df, columns):
+    """
+    Method that checks that a dataframe has the given columns with the given kind of values.
+    Integer columns read with empty values come back as floats, those rows are reported.
+    Empty values in string and float columns are left to the checks of the caller
+    :param df: dataframe to check
+    :param columns: dict from column name to 'integer', 'number' or 'string'
+    :return: list of problems
+    """
+    is_kind = {'integer': pd.api.types.is_integer_dtype,
+               'number': pd.api.types.is_numeric_dtype,
+               'string': lambda series: pd.api.types.is_object_dtype(series) or
+               pd.api.types.is_string_dtype(series)}
+    missing = [column for column in columns if column not in df.columns]
+    if missing:
+        return ['missing columns {}, found {}'.format(examples(missing, len(missing)), ', '.join(map(str, df.columns)))]
+
+    problems = []
+    for column, kind in columns.items():
+        if is_kind[kind](df[column]):
+            continue
+        empty = df.index[df[column].isna().to_numpy()]
+        if len(empty):
+            problems.append('{} is empty in rows {}'.format(column, examples(empty)))
+        else:
+            problems.append('{} should hold {} values, it has dtype {}'.format(column, kind, df[column].dtype))
+    return problems
+
+
+def sorted_codes(values):
+    """
+    Method that replaces values by their position among the sorted distinct values, in a
+    single hashing pass over the values
+    :param values: array
+    :return: int array of codes, -1 for empty values, and the sorted distinct values
+    """
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(uniques, kind='stable')
+    rank = np.empty(len(order), dtype=np.intp)
+    rank[order] = np.arange(len(order))
+    return np.where(codes < 0, -1, rank[codes]), uniques[order]
+
+
+def lat_lon_problems(lat_lon_df, states):
+    """
+    Method that checks that state_lat_lon.csv has one row for every state, within US_BOUNDS
+    :param lat_lon_df: df for latitude and longitude values for each state
+    :param states: array of state names the coordinates are joined to
+    :return: list of problems
+    """
+    problems = column_problems(lat_lon_df, LAT_LON_COLUMNS)
+    if problems:
+        return problems
+
+    names = lat_lon_df['State']
+    duplicated = names[names.duplicated()].unique()
+    if len(duplicated):
+        problems.append('several coordinates for {}'.format(examples(duplicated)))
+    missing = np.setdiff1d(states, names.to_numpy()) if len(states) else []
+    if len(missing):
+        problems.append('no coordinates for {}'.format(examples(missing)))
+
+    for column, (low, high) in zip(('Latitude', 'Longitude'), US_BOUNDS):
+        values = lat_lon_df[column].to_numpy(dtype=float)
+        # Also true for empty values
+        outside = ~((values >= low) & (values <= high))
+        if outside.any():
+            problems.append('{} outside [{}, {}] for {}'.format(column, low, high, examples(
+                '{} ({})'.format(name, value) for name, value in zip(names[outside], values[outside]))))
+    return problems
+
+
+def validate_migration(base_df, lat_lon_df):
+    """
+    Method that checks the long migration dataframe in one vectorized pass before it is
+    scattered into the flow tensor: the columns and their dtypes, that there are rows, that
+    every state has a single id and appears as both an origin and a destination, that no
+    origin, destination, race and quintile cell is listed twice, that the counts fit the
+    int32 bundle, and that every state has coordinates. Cells of the grid missing from the data are counts of
+    zero, they are reported with a warning
+    :param base_df: df for migrations from all states to all states
+    :param lat_lon_df: df for latitude and longitude values for each state
+    :return: dict with the states, state_ids, races and quintiles lookup arrays, the flat
+             tensor position of every row as cells, and the number of missing_cells
+    :raises DataValidationError: listing every problem found
+    """
+    if base_df.empty:
+        raise DataValidationError(['no rows, so no states'])
+    problems = column_problems(base_df, MIGRATION_COLUMNS)
+    if problems:
+        raise DataValidationError(problems)
+
+    n_rows = len(base_df)
+    name_codes, states = sorted_codes(np.concatenate([base_df['o_state_name'].to_numpy(),
+                                                      base_df['d_state_name'].to_numpy()]))
+    race_codes, races = sorted_codes(base_df['race'].to_numpy())
+    quintile_codes, quintiles = sorted_codes(base_df['quintile'].to_numpy())
+    o_codes, d_codes = name_codes[:n_rows], name_codes[n_rows:]
+    for column, codes in (('o_state_name', o_codes), ('d_state_name', d_codes), ('race', race_codes)):
+        empty = base_df.index[codes < 0]
+        if len(empty):
+            problems.append('{} is empty in rows {}'.format(column, examples(empty)))
+    if problems:
+        raise DataValidationError(problems)
+
+    # Every state takes the id of its first row, the rows that disagree are reported
+    ids = np.concatenate([base_df['o_state_id'].to_numpy(), base_df['d_state_id'].to_numpy()])
+    first = np.empty(len(states), dtype=np.intp)
+    first[name_codes[::-1]] = np.arange(len(name_codes))[::-1]
+    state_ids = ids[first]
+    conflicting = np.flatnonzero(ids != state_ids[name_codes])
+    if len(conflicting):
+        problems.append('several ids for the same state: {}'.format(examples(
+            '{} has id {} in row {}, {} elsewhere'.format(states[code], value, base_df.index[row % n_rows], expected)
+            for code, value, row, expected in zip(name_codes[conflicting], ids[conflicting], conflicting,
+                                                  state_ids[name_codes[conflicting]]))))
+    shared = pd.Series(states).groupby(state_ids).agg(list)
+    shared = shared[shared.str.len() > 1]
+    if len(shared):
+        problems.append('the same id for several states: {}'.format(examples(
+            '{} ({})'.format(state_id, ', '.join(names)) for state_id, names in shared.items())))
+
+    for codes, side in ((o_codes, 'an origin'), (d_codes, 'a destination')):
+        absent = states[np.bincount(codes, minlength=len(states)) == 0]
+        if len(absent):
+            problems.append('never {}: {}'.format(side, examples(absent)))
+
+    n = base_df['n'].to_numpy()
+    too_large = base_df.index[np.abs(n) > np.iinfo(np.int32).max]
+    if len(too_large):
+        problems.append('n does not fit in 32 bits in rows {}'.format(examples(too_large)))
+
+    shape = (len(states), len(states), len(races), len(quintiles))
+    cells = np.ravel_multi_index((o_codes, d_codes, race_codes, quintile_codes), shape)
+    rows_per_cell = np.bincount(cells, minlength=int(np.prod(shape)))
+
+    repeated = np.flatnonzero(rows_per_cell > 1)
+    if len(repeated):
+        o, d, r, q = np.unravel_index(repeated, shape)
+        problems.append('origin, destination, race and quintile cells listed more than once: {}'.format(
+            examples(zip(states[o], states[d], races[r], quintiles[q]))))
+
+    problems += lat_lon_problems(lat_lon_df, states)
+    if problems:
+        raise DataValidationError(problems)
+
+    missing = np.flatnonzero(rows_per_cell == 0)
+    if len(missing):
+        o, d, r, q = np.unravel_index(missing, shape)
+        warnings.warn('{} of {} origin, destination, race and quintile cells are missing and counted as 0: {}'.format(
+            len(missing), len(rows_per_cell), examples(zip(states[o], states[d], races[r], quintiles[q]))),
+            stacklevel=3)
+
+    return {'states': states, 'state_ids': state_ids, 'races': races, 'quintiles': quintiles,
+            'cells': cells, 'missing_cells': len(missing)}
+
+
+def build_flow_tensor(base_df, lat_lon_df):
+    """
+    Method that validates the long migration dataframe and scatters it into a dense
+    origin x destination x race x quintile array of counts, with zeros for missing cells
+    :param base_df: df for migrations from all states to all states
+    :param lat_lon_df: df for latitude and longitude values for each state
+    :return: FlowTensor
+    :raises DataValidationError: when the data does not pass validate_migration
+    """
+    valid = validate_migration(base_df, lat_lon_df)
+    states = valid['states']
+
+    flows = np.zeros((len(states), len(states), len(valid['races']), len(valid['quintiles'])), dtype=np.int64)
+    # Every cell is listed at most once, so the counts are assigned rather than accumulated
+    flows.reshape(-1)[valid['cells']] = base_df['n'].to_numpy()
+
+    flows = FlowTensor(flows, states, valid['state_ids'], valid['races'], valid['quintiles'],
+                       state_lat_lon(lat_lon_df, states))
+    flows.validation = {'version': VALIDATION_VERSION, 'rows': len(base_df), 'missing_cells': valid['missing_cells']}
+    return flows
+
+
+def state_lat_lon(lat_lon_df, states):
+    """
+    Method that lines up the latitude and longitude values with the state codes
+    :param lat_lon_df: df for latitude and longitude values for each state
+    :param states: array of state names, position is the state code
+    :return: float array of shape (n_states, 2)
+    :raises DataValidationError: when a state has no coordinates, or coordinates outside US_BOUNDS
+    """
+    problems = lat_lon_problems(lat_lon_df, states)
+    if problems:
+        raise DataValidationError(problems, 'latitude/longitude data')
+    return lat_lon_df.set_index('State')\
+                     .reindex(states)[['Latitude', 'Longitude']]\
+                     .to_numpy(dtype=float)
+
+
+@timed
+def load_flow_tensor(migration_path='state_to_state_migration.csv', lat_lon_path='state_lat_lon.csv',
+                     bundle_path=None):
+    """
+    Method that builds the dense flow tensor. The counts are memory-mapped from the
+    .npy bundle next to the migration csv when it exists and was written from the
+    current csv, otherwise the csv is parsed
+    :param migration_path: path to state_to_state_migration.csv
+    :param lat_lon_path: path to state_lat_lon.csv
+    :param bundle_path: path to the bundle directory, defaults to migration_path without extension
+    :return: FlowTensor
+    """
+    if bundle_path is None:
+        bundle_path = default_bundle_path(migration_path)
+    lat_lon_df = pd.read_csv(lat_lon_path)
+
+    if bundle_is_current(bundle_path, migration_path):
+        return read_flow_bundle(bundle_path, lat_lon_df, lat_lon_path)
+
+    base_df = pd.read_csv(migration_path, index_col=0)
+    return build_flow_tensor(base_df, lat_lon_df)
+
+
+# Columnar .npy bundle: the dense int32 count tensor plus the lookup arrays that
+# turn its integer codes back into state, race and quintile values
+BUNDLE_ARRAYS = ('flows', 'states', 'state_ids', 'races', 'quintiles')
+BUNDLE_META = 'meta.json'
+# Per-origin averages behind the national statistics, stored as avg_<key>.npy
+AVERAGE_KEYS = ('overall', 'race', 'race_quintile')
+
+
+def default_bundle_path(migration_path):
+    return os.path.splitext(migration_path)[0]
+
+
+def write_flow_bundle(flows, bundle_path, migration_path, lat_lon_path='state_lat_lon.csv', averages=None):
+    """
+    Method that saves a FlowTensor as a directory of .npy files, along with its per-origin
+    average distances. The content hashes of the csv files it was built from are recorded
+    so that stale bundles can be detected, as is the summary of the validation it passed. Every file is written next to its target and
+    renamed over it, so running workers keep reading the bundle they mapped
+    :param flows: FlowTensor
+    :param bundle_path: directory to write the bundle to
+    :param migration_path: path to the csv the tensor was built from
+    :param lat_lon_path: path to the latitude/longitude csv the distances were computed from
+    :param averages: dict from origin_averages, computed when not given
+    """
+    if flows.validation is None:
+        raise ValueError('Only tensors validated by build_flow_tensor are written to a bundle')
+    if averages is None:
+        averages = origin_averages(flows)
+
+    os.makedirs(bundle_path, exist_ok=True)
+    arrays = {'flows': flows.flows.astype(np.int32),
+              'states': flows.states.astype(str),
+              'state_ids': flows.state_ids.astype(np.int32),
+              'races': flows.races.astype(str),
+              'quintiles': flows.quintiles.astype(np.int32)}
+    arrays.update({'avg_' + key: averages[key] for key in AVERAGE_KEYS})
+    for name, array in arrays.items():
+        path = os.path.join(bundle_path, name + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array, allow_pickle=False)
+        os.replace(path + '.tmp', path)
+
+    meta_path = os.path.join(bundle_path, BUNDLE_META)
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'source': os.path.basename(migration_path),
+                   'source_version': data_version(migration_path),
+                   'lat_lon_version': data_version(lat_lon_path),
+                   'validation': flows.validation}, f, indent=2)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def update_flow_bundle(flows, bundle_path, migration_path, lat_lon_path='state_lat_lon.csv'):
+    """
+    Method that rewrites a bundle for new counts, recomputing the per-origin averages only
+    for origins whose counts changed. Everything is recomputed when there is no previous
+    bundle, or when its states, races, quintiles or coordinates differ
+    :param flows: FlowTensor with the new counts
+    :param bundle_path: bundle directory
+    :param migration_path: path to the csv the tensor was built from
+    :param lat_lon_path: path to the latitude/longitude csv
+    :return: array of the origin codes whose averages were recomputed
+    """
+    averages = None
+    changed = np.arange(len(flows.states))
+    meta_path = os.path.join(bundle_path, BUNDLE_META)
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(bundle_path, name + '.npy'), allow_pickle=False)
+
+        try:
+            same_grid = meta.get('lat_lon_version') == data_version(lat_lon_path) and \
+                all(np.array_equal(load(name), getattr(flows, name).astype(load(name).dtype))
+                    for name in ('states', 'races', 'quintiles'))
+            if same_grid:
+                previous = load('flows')
+                averages = {key: load('avg_' + key) for key in AVERAGE_KEYS}
+        except (OSError, ValueError):
+            averages = None
+
+        if averages is not None:
+            changed = np.flatnonzero((previous != flows.flows).any(axis=(1, 2, 3)))
+            fresh = origin_averages(flows, changed)
+            for key in AVERAGE_KEYS:
+                averages[key][changed] = fresh[key]
+
+    write_flow_bundle(flows, bundle_path, migration_path, lat_lon_path, averages=averages)
+    return changed
+
+
+def bundle_is_current(bundle_path, migration_path):
+    """
+    Method that checks whether the bundle exists and was written from the current csv by
+    the current validation
+    :param bundle_path: bundle directory
+    :param migration_path: path to state_to_state_migration.csv
+    :return: bool
+    """
+    meta_path = os.path.join(bundle_path, BUNDLE_META)
+    if not os.path.exists(meta_path):
+        return False
+    if not all(os.path.exists(os.path.join(bundle_path, name + '.npy')) for name in BUNDLE_ARRAYS):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta.get('source_version') == data_version(migration_path) and \
+        meta.get('validation', {}).get('version') == VALIDATION_VERSION
+
+
+def read_flow_bundle(bundle_path, lat_lon_df, lat_lon_path='state_lat_lon.csv'):
+    """
+    Method that loads a bundle written by write_flow_bundle. The count tensor is
+    memory-mapped read-only, so workers share the pages instead of each holding a copy.
+    The counts were validated when the bundle was written, only the coordinates are checked
+    again. The stored per-origin averages are only used if the coordinates have not changed
+    :param bundle_path: bundle directory
+    :param lat_lon_df: df for latitude and longitude values for each state
+    :param lat_lon_path: path lat_lon_df was read from
+    :return: FlowTensor
+    :raises DataValidationError: when a state has no coordinates, or coordinates outside US_BOUNDS
+    """
+    def load(name, mmap_mode=None):
+        return np.load(os.path.join(bundle_path, name + '.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+
+    states = load('states').astype(object)
+    flows = FlowTensor(load('flows', mmap_mode='r'), states, load('state_ids'), load('races').astype(object),
+                       load('quintiles'), state_lat_lon(lat_lon_df, states))
+
+    with open(os.path.join(bundle_path, BUNDLE_META)) as f:
+        meta = json.load(f)
+    flows.validation = meta.get('validation')
+    average_files = [os.path.join(bundle_path, 'avg_' + key + '.npy') for key in AVERAGE_KEYS]
+    if meta.get('lat_lon_version') == data_version(lat_lon_path) and all(map(os.path.exists, average_files)):
+        flows.origin_averages = {key: load('avg_' + key) for key in AVERAGE_KEYS}
+    return flows
+
+
+COHORTS_MANIFEST = 'cohorts.json'
+
+
+class CohortFlows:
+    """
+    Several cohorts or vintages of the migration data side by side, as listed in cohorts.json.
+    Every cohort has its own state_to_state_migration csv and .npy bundle, and its FlowTensor
+    is only loaded when the cohort is first asked for. The counts are memory-mapped, so a
+    cohort adds to the resident memory of a worker only once it is selected there, and only
+    for the origins that are queried
+    """
+
+    def __init__(self, cohorts, lat_lon_path='state_lat_lon.csv', base_path='.'):
+        """
+        :param cohorts: list of dicts with the name, label and migration csv path of every cohort,
+                        in the order they are shown and compared
+        :param lat_lon_path: path to state_lat_lon.csv, shared by every cohort
+        :param base_path: directory the migration csv paths are relative to
+        """
+        if not cohorts:
+            raise ValueError('no cohorts')
+        self.cohorts = OrderedDict((cohort['name'], cohort) for cohort in cohorts)
+        self.names = list(self.cohorts)
+        self.lat_lon_path = lat_lon_path
+        self.base_path = base_path
+        self._flows = {}
+        self._lock = threading.Lock()
+
+    def label(self, name):
+        return self.cohorts[name].get('label', name)
+
+    def migration_path(self, name):
+        return os.path.join(self.base_path, self.cohorts[name]['migration'])
+
+    def version(self, name=None):
+        """
+        :param name: cohort name, None for all cohorts together
+        :return: data version of the cohort's files
+        """
+        names = self.names if name is None else [name]
+        return data_version(*[self.migration_path(name) for name in names], self.lat_lon_path)
+
+    def flows(self, name):
+        """
+        Method that returns the FlowTensor of a cohort, loading it on first use and again
+        whenever its files change. Every cohort must have the same states, races and quintiles
+        :param name: cohort name
+        :return: FlowTensor
+        """
+        version = self.version(name)
+        with self._lock:
+            if name in self._flows and self._flows[name][0] == version:
+                return self._flows[name][1]
+            flows = load_flow_tensor(self.migration_path(name), self.lat_lon_path)
+            # The previous tensor of the same cohort is replaced, not compared with
+            for other_name, (_, other) in self._flows.items():
+                if other_name != name and not all(np.array_equal(getattr(flows, key), getattr(other, key))
+                           for key in ('states', 'races', 'quintiles')):
+                    raise ValueError('Cohort {} does not have the states, races and quintiles of the other cohorts'
+                                     .format(name))
+            self._flows[name] = (version, flows)
+            return flows
+
+
+def read_cohorts(manifest_path=COHORTS_MANIFEST, lat_lon_path='state_lat_lon.csv'):
+    """
+    Method that reads the list of cohorts
+    :param manifest_path: path to cohorts.json
+    :param lat_lon_path: path to state_lat_lon.csv
+    :return: CohortFlows
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    return CohortFlows(manifest['cohorts'], lat_lon_path, os.path.dirname(manifest_path))
+
+
+def register_cohort(name, migration_path, label=None, manifest_path=COHORTS_MANIFEST):
+    """
+    Method that adds a cohort to cohorts.json, or points an existing one to a new csv
+    :param name: cohort name
+    :param migration_path: path to the cohort's state_to_state_migration csv
+    :param label: description shown in the cohort selector
+    :param manifest_path: path to cohorts.json
+    """
+    cohorts = []
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            cohorts = json.load(f)['cohorts']
+
+    entry = {'name': name, 'label': label or name,
+             'migration': os.path.relpath(migration_path, os.path.dirname(os.path.abspath(manifest_path)))}
+    previous = [idx for idx, cohort in enumerate(cohorts) if cohort['name'] == name]
+    if previous:
+        if label is None:
+            entry['label'] = cohorts[previous[0]].get('label', name)
+        cohorts[previous[0]] = entry
+    else:
+        cohorts.append(entry)
+
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'cohorts': cohorts}, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+_data_versions = {}
+# Bytes read at a time by data_version
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def data_version(*paths):
+    """
+    Method that returns a content hash of the given data files, used to key
+    anything precomputed from them. The hash is only recomputed when a file's
+    size or modification time changes
+    :param paths: paths to the data files
+    :return: hex digest
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+        if key not in _data_versions:
+            file_digest = hashlib.sha256()
+            with open(path, 'rb') as f:
+                # Read in blocks, so that hashing a large extract does not hold it in memory
+                for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                    file_digest.update(block)
+            _data_versions[key] = file_digest.hexdigest()
+        digest.update(_data_versions[key].encode())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def us_states_topology(path='us_states_topo.json'):
+    """
+    Method that reads the bundled TopoJSON of the 50 states and DC, loaded once per process.
+    Its 'states' object has one geometry per state with the FIPS id used by the
+    migration data, so the charts do not need to fetch vega_datasets' us_10m
+    :param path: path to us_states_topo.json
+    :return: topology dict
+    """
+    with open(path) as f:
+        return json.load(f)
+
+
+@timed
+def migration_data(flows, source):
+    """
+    Method that produces a dataframe of the number of people
+    moving from the selected state on the map to every state.
+    Along with that it appends the corresponding latitutde and
+    longitude values for all the states in the resulting df
+    :param flows: FlowTensor, or sparse_flows.SparseFlows for finer geographies
+    :param source: selected state
+    :return: migration_df
+    """
+    s = flows.state_code(source)
+    order = flows.id_order
+    counts = flows.origin_flows(s).sum(axis=(1, 2))
+
+    return pd.DataFrame({'d_state_id': flows.state_ids[order],
+                         'd_state_name': flows.states[order],
+                         'n': counts[order],
+                         'State': flows.states[order],
+                         'Latitude': flows.lat_lon[order, 0],
+                         'Longitude': flows.lat_lon[order, 1]})
+
+
+def distance_matrix(lat_lon, other=None):
+    """
+    Method that calculates the great-circle distance between every pair of
+    points in one vectorized pass
+    :param lat_lon: float array of shape (n, 2) with latitude and longitude in degrees
+    :param other: float array of shape (m, 2), defaults to lat_lon
+    :return: (n, m) array of distances in miles
+    """
+    lat, lon = np.radians(lat_lon).T
+    other_lat, other_lon = np.radians(lat_lon if other is None else other).T
+    d_lat = other_lat[None, :] - lat[:, None]
+    d_lon = other_lon[None, :] - lon[:, None]
+
+    d = np.sin(d_lat * 0.5) ** 2 + np.cos(lat)[:, None] * np.cos(other_lat)[None, :] * np.sin(d_lon * 0.5) ** 2
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(d))
+
+
+@timed
+def miles_moved_race(flows, source):
+    """
+    Function that takes the flow tensor and source, and calculates the weighted average of the distance
+    moved by each race
+    :param flows: FlowTensor, or sparse_flows.SparseFlows for finer geographies
+    :param source: selected state
+    :return: df with average distance moved for each race
+    """
+    s = flows.state_code(source)
+    others = np.arange(len(flows.states)) != s
+
+    # destination x race counts, excluding people who stayed in the source state
+    numbers_array = np.abs(flows.origin_flows(s)[others].sum(axis=2))
+
+    weighted_distance = np.einsum('d,dr->r', flows.origin_distances(s)[others], numbers_array)
+    return pd.DataFrame({'Race': flows.races,
+                         'Distance': np.round(weighted_distance/np.sum(numbers_array, axis=0), 2)})
+
+
+@timed
+def miles_moved_race_q(flows, source):
+    """
+        Function that takes the flow tensor and source, and calculates the weighted average of the distance
+        moved by each race and quintile
+        :param flows: FlowTensor, or sparse_flows.SparseFlows for finer geographies
+        :param source: selected state
+        :return: df with average distance moved for each race
+    """
+    s = flows.state_code(source)
+    others = np.arange(len(flows.states)) != s
+
+    # destination x race x quintile counts, excluding people who stayed in the source state
+    numbers_array = np.abs(flows.origin_flows(s)[others])
+
+    weighted_distance = np.einsum('d,drq->rq', flows.origin_distances(s)[others], numbers_array)
+    n_races, n_quintiles = weighted_distance.shape
+    return pd.DataFrame({'Race': np.repeat(flows.races, n_quintiles),
+                         'Quintile': np.tile(flows.quintiles, n_races),
+                         'Distance': np.round(weighted_distance/np.sum(numbers_array, axis=0), 2).ravel()})
+
+
+@timed
+def distance_intervals(flows, source, method='bootstrap', level=0.95, replicates=1000, seed=0, workers=None):
+    """
+    Method that adds confidence intervals to the average distances of miles_moved_race and
+    miles_moved_race_q. 'bootstrap' is the Poisson bootstrap of the people who left the
+    source state: each replicate draws every destination x race x quintile count from a
+    Poisson distribution around the observed count, and the race replicates are the sums
+    of the quintile ones. The replicates are drawn in batches of one array operation each,
+    spread over a thread pool. 'analytic' uses the normal approximation, the weighted
+    standard deviation of the distances over the square root of the number of people
+    :param flows: FlowTensor, or sparse_flows.SparseFlows for finer geographies
+    :param source: selected state
+    :param method: 'bootstrap' or 'analytic'
+    :param level: confidence level of the intervals
+    :param replicates: number of bootstrap replicates
+    :param seed: seed of the bootstrap, the intervals do not depend on the number of threads
+    :param workers: number of threads drawing replicates, defaults to the ThreadPoolExecutor default
+    :return: race df like miles_moved_race and race_quintile df like miles_moved_race_q,
+             both with Lower and Upper columns
+    """
+    s = flows.state_code(source)
+    others = np.arange(len(flows.states)) != s
+
+    # destination x race (x quintile) counts, excluding people who stayed in the source state,
+    # with the absolute values taken as in miles_moved_race and miles_moved_race_q. The
+    # bootstrap needs non-negative cells, so its race replicates sum the absolute quintile counts.
+    # Destinations nobody moved to do not change any replicate
+    flow_counts = flows.origin_flows(s)[others]
+    moved = flow_counts.any(axis=(1, 2))
+    counts = np.abs(flow_counts[moved])
+    race_counts = np.abs(flow_counts[moved].sum(axis=2))
+    distances = flows.origin_distances(s)[others][moved]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        race_distance = np.einsum('d,dr->r', distances, race_counts)/race_counts.sum(axis=0)
+        race_q_distance = np.einsum('d,drq->rq', distances, counts)/counts.sum(axis=0)
+
+        if method == 'bootstrap':
+            race_samples, race_q_samples = bootstrap_distances(counts, distances, replicates, seed, workers)
+            race_bounds = replicate_bounds(race_samples, level)
+            race_q_bounds = replicate_bounds(race_q_samples, level)
+        elif method == 'analytic':
+            race_bounds = normal_bounds(race_counts, distances, race_distance, level)
+            race_q_bounds = normal_bounds(counts, distances, race_q_distance, level)
+        else:
+            raise ValueError("method must be 'bootstrap' or 'analytic', not {!r}".format(method))
+
+    n_races, n_quintiles = race_q_distance.shape
+    race_df = pd.DataFrame({'Race': flows.races,
+                            'Distance': np.round(race_distance, 2),
+                            'Lower': np.round(race_bounds[0], 2),
+                            'Upper': np.round(race_bounds[1], 2)})
+    race_q_df = pd.DataFrame({'Race': np.repeat(flows.races, n_quintiles),
+                              'Quintile': np.tile(flows.quintiles, n_races),
+                              'Distance': np.round(race_q_distance, 2).ravel(),
+                              'Lower': np.round(race_q_bounds[0], 2).ravel(),
+                              'Upper': np.round(race_q_bounds[1], 2).ravel()})
+    return race_df, race_q_df
+
+
+# Bootstrap replicates drawn per array operation, which bounds the memory of a batch to
+# BOOTSTRAP_BATCH x destinations x races x quintiles counts
+BOOTSTRAP_BATCH = 100
+
+
+def bootstrap_distances(counts, distances, replicates, seed=0, workers=None):
+    """
+    Method that draws Poisson bootstrap replicates of the average distance moved
+    :param counts: destination x race x quintile counts
+    :param distances: distance to every destination
+    :param replicates: number of replicates
+    :param seed: seed, every batch gets its own generator spawned from it
+    :param workers: number of threads
+    :return: replicates x race and replicates x race x quintile arrays of average distances
+    """
+    sizes = [min(BOOTSTRAP_BATCH, replicates - start) for start in range(0, replicates, BOOTSTRAP_BATCH)]
+    generators = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(len(sizes))]
+    expected = counts.astype(float)
+
+    def draw(batch):
+        rng, size = batch
+        sample = rng.poisson(expected, size=(size,) + expected.shape)
+        weighted = np.einsum('d,bdrq->brq', distances, sample)
+        people = sample.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return weighted.sum(axis=2)/people.sum(axis=2), weighted/people
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batches = list(executor.map(draw, zip(generators, sizes)))
+    return np.concatenate([race for race, _ in batches]), np.concatenate([race_q for _, race_q in batches])
+
+
+def replicate_bounds(samples, level):
+    """
+    Method that takes the percentile interval of bootstrap replicates, ignoring replicates
+    where nobody moved. Cells without any replicate get nan
+    :param samples: replicates x ... array
+    :param level: confidence level
+    :return: lower and upper bound arrays
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanpercentile(samples, [50 * (1 - level), 50 * (1 + level)], axis=0)
+
+
+def normal_bounds(counts, distances, mean, level):
+    """
+    Method that computes the normal approximation interval of an average distance
+    :param counts: destination x ... counts
+    :param distances: distance to every destination
+    :param mean: average distance of every cell
+    :param level: confidence level
+    :return: lower and upper bound arrays
+    """
+    people = counts.sum(axis=0)
+    variance = np.einsum('d,d...->...', distances ** 2, counts)/people - mean ** 2
+    half_width = NormalDist().inv_cdf(0.5 + level / 2) * np.sqrt(np.maximum(variance, 0)/people)
+    return mean - half_width, mean + half_width
+
+
+@timed
+def global_average_distance(flows):
+    '''
+    For each state, using it as the source, we take the number of people moving to every
+    state and weight the distance between the states by it. All sources are handled at once
+    as a row-wise product of the count matrix with the distance matrix.
+    '''
+    numbers_array = np.abs(flows.flows.sum(axis=(2, 3)))
+
+    weighted_distance = np.einsum('od,od->o', flows.distances, numbers_array)
+    distances_state_wise = np.round(weighted_distance/np.sum(numbers_array, axis=1), 2)
+    return np.round(np.mean(distances_state_wise), 2)
+
+
+@timed
+def origin_averages(flows, origins=None):
+    """
+    Method that computes the average distance moved from each origin: overall (as in
+    global_average_distance), by race and by race and quintile. As in miles_moved_race
+    and miles_moved_race_q, the race and quintile averages only count people who left
+    their state. Origins with nobody moving in a cell get nan
+    :param flows: FlowTensor
+    :param origins: origin codes to compute, all origins by default
+    :return: dict of 'overall' (o,), 'race' (o, r) and 'race_quintile' (o, r, q) arrays
+    """
+    if origins is None:
+        origins = np.arange(len(flows.states))
+    counts = flows.flows[origins]
+    distances = flows.distances[origins]
+    moved = np.arange(len(flows.states))[None, :] != origins[:, None]
+
+    numbers_array = np.abs(counts.sum(axis=(2, 3)))
+    # origin x destination x race (x quintile) counts, zeroing people who stayed
+    race_counts = np.abs(counts.sum(axis=3)) * moved[:, :, None]
+    race_q_counts = np.abs(counts) * moved[:, :, None, None]
+
+    weighted = np.einsum('od,od->o', distances, numbers_array)
+    race_weighted = np.einsum('od,odr->or', distances, race_counts)
+    race_q_weighted = np.einsum('od,odrq->orq', distances, race_q_counts)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {'overall': np.round(weighted/numbers_array.sum(axis=1), 2),
+                'race': np.round(race_weighted/race_counts.sum(axis=1), 2),
+                'race_quintile': np.round(race_q_weighted/race_q_counts.sum(axis=1), 2)}
+
+
+@timed
+def national_statistics(flows):
+    """
+    Method that computes the national average distances as the mean of the per-origin
+    averages from origin_averages, taken from the bundle when it has them and kept on
+    flows otherwise
+    :param flows: FlowTensor
+    :return: dict with 'overall' distance, 'race' df and 'race_quintile' df
+    """
+    if flows.origin_averages is None:
+        flows.origin_averages = origin_averages(flows)
+    averages = flows.origin_averages
+
+    with np.errstate(invalid='ignore'):
+        race_avg = np.nanmean(averages['race'], axis=0)
+        race_q_avg = np.nanmean(averages['race_quintile'], axis=0)
+
+    n_races, n_quintiles = race_q_avg.shape
+    race_df = pd.DataFrame({'Race': flows.races,
+                            'Distance': np.round(race_avg, 2)})
+    race_q_df = pd.DataFrame({'Race': np.repeat(flows.races, n_quintiles),
+                              'Quintile': np.tile(flows.quintiles, n_races),
+                              'Distance': np.round(race_q_avg, 2).ravel()})
+
+    return {'overall': np.round(np.mean(averages['overall']), 2),
+            'race': race_df,
+            'race_quintile': race_q_df}
+
+
+@timed
+def race_data(flows, source):
+    """
+    Method that produces the number of people moving out of the selected state
+    by race, and by race and quintile
+    :param flows: FlowTensor, or sparse_flows.SparseFlows for finer geographies
+    :param source: selected state
+    :return: race_df, quintile_df
+    """
+    s = flows.state_code(source)
+
+    # Everyone leaving the source state: all destinations minus the source itself
+    counts = flows.origin_flows(s)
+    leaving = counts.sum(axis=0) - counts[s]
+    n_races, n_quintiles = leaving.shape
+
+    race_df = pd.DataFrame({'o_state_name': source,
+                            'race': flows.races,
+                            'n': leaving.sum(axis=1)})
+    quintile_df = pd.DataFrame({'o_state_name': source,
+                                'race': np.repeat(flows.races, n_quintiles),
+                                'quintile': np.tile(flows.quintiles, n_races),
+                                'n': leaving.ravel()})
+
+    return race_df, quintile_df
+
+
+@timed
+def cohort_comparison(cohorts, source, names=None, baseline=None):
+    """
+    Method that compares the cohorts for the selected state. The origin rows of every
+    cohort are stacked into one cohort x destination x race x quintile array, so the
+    average distances by race (as in miles_moved_race) and the people moving to every
+    destination (as in migration_data) of all cohorts, and their differences from the
+    baseline cohort, are each computed in one vectorized pass
+    :param cohorts: CohortFlows
+    :param source: selected state
+    :param names: cohorts to compare, all by default
+    :param baseline: cohort the changes are relative to, the first one by default
+    :return: dict with 'race_distance' df (Cohort, Race, Distance, Change) and
+             'destinations' df (Cohort, d_state_id, d_state_name, n, Change)
+    """
+    names = list(cohorts.names if names is None else names)
+    tensors = [cohorts.flows(name) for name in names]
+    first = tensors[0]
+    s = first.state_code(source)
+    others = np.arange(len(first.states)) != s
+    base = names.index(names[0] if baseline is None else baseline)
+
+    counts = np.stack([np.asarray(flows.origin_flows(s)) for flows in tensors]).astype(np.int64)
+    # cohort x destination x race counts, excluding people who stayed in the source state
+    race_counts = np.abs(counts[:, others].sum(axis=3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        distance = np.round(np.einsum('d,cdr->cr', first.origin_distances(s)[others], race_counts)
+                            / race_counts.sum(axis=1), 2)
+    destinations = counts.sum(axis=(2, 3))[:, first.id_order]
+
+    n_cohorts, n_races = distance.shape
+    n_states = len(first.states)
+    race_df = pd.DataFrame({'Cohort': np.repeat(names, n_races),
+                            'Race': np.tile(first.races, n_cohorts),
+                            'Distance': distance.ravel(),
+                            'Change': np.round(distance - distance[base], 2).ravel()})
+    destination_df = pd.DataFrame({'Cohort': np.repeat(names, n_states),
+                                   'd_state_id': np.tile(first.state_ids[first.id_order], n_cohorts),
+                                   'd_state_name': np.tile(first.states[first.id_order], n_cohorts),
+                                   'n': destinations.ravel(),
+                                   'Change': (destinations - destinations[base]).ravel()})
+    return {'race_distance': race_df, 'destinations': destination_df}
+
+
+class FlowRanking:
+    """
+    Rankings of the flows of a FlowTensor computed ahead of time, for every origin and every
+    filter: all people, one race, one quintile, or one race and quintile. For each of them
+    the destinations are stored sorted by the number of people moving there, and for every
+    destination the origins sorted by the number of people coming from them, so top K lists
+    are slices. The race and quintile with the most people leaving, and those moving the
+    farthest on average, are stored for every origin
+    """
+
+    def __init__(self, flows):
+        """
+        :param flows: FlowTensor
+        """
+        self.flows = flows
+        n_states, _, n_races, n_quintiles = flows.flows.shape
+
+        # race x quintile x origin x destination counts, where race n_races and quintile
+        # n_quintiles stand for all races and all quintiles
+        counts = np.zeros((n_races + 1, n_quintiles + 1, n_states, n_states), dtype=np.int64)
+        counts[:n_races, :n_quintiles] = np.asarray(flows.flows).transpose(2, 3, 0, 1)
+        counts[n_races] = counts[:n_races].sum(axis=0)
+        counts[:, n_quintiles] = counts[:, :n_quintiles].sum(axis=1)
+        self.counts = counts
+
+        # People staying in their state are ranked last, after every other destination or origin
+        staying = np.eye(n_states, dtype=bool)
+        sort_key = np.where(staying, np.iinfo(np.int64).max, -counts)
+        self.destination_order = np.argsort(sort_key, axis=3, kind='stable').astype(np.int32)
+        self.origin_order = np.argsort(sort_key, axis=2, kind='stable').astype(np.int32)
+
+        leaving = counts.sum(axis=3) - counts[..., staying]
+        self.dominant_races = leaving[:n_races, n_quintiles].argmax(axis=0)
+        self.dominant_quintiles = leaving[:, :n_quintiles].argmax(axis=1)
+
+        if flows.origin_averages is None:
+            flows.origin_averages = origin_averages(flows)
+        self.farthest_races = nan_argmax(flows.origin_averages['race'], axis=1)
+        self.farthest_quintiles = nan_argmax(flows.origin_averages['race_quintile'], axis=2)
+
+    def filter_codes(self, race=None, quintile=None):
+        """
+        :param race: race name, None for all races
+        :param quintile: quintile value, None for all quintiles
+        :return: race and quintile positions in the counts
+        """
+        r = len(self.flows.races) if race is None else list(self.flows.races).index(race)
+        q = len(self.flows.quintiles) if quintile is None else list(self.flows.quintiles).index(quintile)
+        return r, q
+
+    def top_destinations(self, source, k=10, race=None, quintile=None):
+        """
+        Method that returns the k destinations most people moved to from the source state
+        :param source: selected state
+        :param k: number of destinations, at most the number of other states
+        :param race: only count this race, None for all races
+        :param quintile: only count this quintile, None for all quintiles
+        :return: df with d_state_id, d_state_name and n, by decreasing n
+        """
+        r, q = self.filter_codes(race, quintile)
+        s = self.flows.state_code(source)
+        top = self.destination_order[r, q, s, :min(k, len(self.flows.states) - 1)]
+        return pd.DataFrame({'d_state_id': self.flows.state_ids[top],
+                             'd_state_name': self.flows.states[top],
+                             'n': self.counts[r, q, s, top]})
+
+    def destination_ranks(self, source, race=None, quintile=None):
+        """
+        Method that returns the rank of every destination of the source state, 1 for the one
+        most people moved to, with the source itself ranked last
+        :param source: selected state
+        :param race: only count this race, None for all races
+        :param quintile: only count this quintile, None for all quintiles
+        :return: int array aligned with the rows of migration_data (FIPS id order)
+        """
+        r, q = self.filter_codes(race, quintile)
+        order = self.destination_order[r, q, self.flows.state_code(source)]
+        ranks = np.empty(len(order), dtype=np.int32)
+        ranks[order] = np.arange(1, len(order) + 1)
+        return ranks[self.flows.id_order]
+
+    def top_origins(self, destination, k=10, race=None, quintile=None):
+        """
+        Method that returns the k origins most people moved from to the destination state
+        :param destination: selected state
+        :param k: number of origins, at most the number of other states
+        :param race: only count this race, None for all races
+        :param quintile: only count this quintile, None for all quintiles
+        :return: df with o_state_id, o_state_name and n, by decreasing n
+        """
+        r, q = self.filter_codes(race, quintile)
+        d = self.flows.state_code(destination)
+        top = self.origin_order[r, q, :min(k, len(self.flows.states) - 1), d]
+        return pd.DataFrame({'o_state_id': self.flows.state_ids[top],
+                             'o_state_name': self.flows.states[top],
+                             'n': self.counts[r, q, top, d]})
+
+    def dominant_race(self, source):
+        """
+        :return: race with the most people leaving the source state
+        """
+        return self.flows.races[self.dominant_races[self.flows.state_code(source)]]
+
+    def dominant_quintile(self, source, race=None):
+        """
+        :return: quintile with the most people of the race (all races by default) leaving the source state
+        """
+        r, _ = self.filter_codes(race)
+        return self.flows.quintiles[self.dominant_quintiles[r, self.flows.state_code(source)]]
+
+    def farthest_race(self, source):
+        """
+        :return: race moving the farthest on average from the source state, as in miles_moved_race
+        """
+        return self.flows.races[self.farthest_races[self.flows.state_code(source)]]
+
+    def farthest_quintile(self, source, race):
+        """
+        :return: quintile of the race moving the farthest on average from the source state,
+                 as in miles_moved_race_q
+        """
+        r, _ = self.filter_codes(race)
+        return self.flows.quintiles[self.farthest_quintiles[self.flows.state_code(source), r]]
+
+
+def nan_argmax(values, axis):
+    """
+    Method like np.nanargmax that returns 0 instead of raising for all-nan slices
+    """
+    return np.where(np.isnan(values), -np.inf, values).argmax(axis=axis)
+
+
+@timed
+def flow_ranking(flows):
+    """
+    Method that returns the FlowRanking of the flows, built on first use and kept on flows
+    :param flows: FlowTensor
+    :return: FlowRanking
+    """
+    if flows.ranking is None:
+        flows.ranking = FlowRanking(flows)
+    return flows.ranking
+
+
+# Query functions whose result only depends on the data and the selected state
+STATE_QUERIES = (migration_data, race_data, miles_moved_race, miles_moved_race_q)
+
+
+def query_key(query):
+    """
+    Method that identifies a query in the QueryCache keys. Functions are keyed on the
+    function object, so two functions with the same name, such as two lambdas, do not share
+    results. Partials are keyed on their function and bound arguments, so equal partials
+    created on different reruns share results
+    :param query: function, or functools.partial of one
+    :return: hashable key
+    """
+    if isinstance(query, functools.partial):
+        return query_key(query.func), query.args, tuple(sorted(query.keywords.items()))
+    return query
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of the per-state query results, keyed on (data version, state, query).
+    One instance is shared by every session, so cached results are handed out as is and
+    must be treated as read-only. Concurrent misses on the same key compute it once, the
+    other callers wait for that result.
+    """
+
+    def __init__(self, maxsize=512):
+        """
+        :param maxsize: number of results kept, the least recently used are evicted first
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        # Future of every key being computed, shared with the callers that miss on it meanwhile
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def get(self, flows, version, query, source):
+        """
+        Method that returns query(flows, source), computing it only if it is neither cached
+        nor being computed by another thread
+        :param flows: FlowTensor
+        :param version: data version of flows
+        :param query: function of (flows, source), such as the ones in STATE_QUERIES, or a
+                      functools.partial of one with hashable bound arguments
+        :param source: selected state
+        :return: result of the query
+        """
+        key = (version, source, query_key(query))
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+            pending = self._pending.get(key)
+            if pending is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                self._pending[key] = computing = Future()
+
+        if pending is not None:
+            return pending.result()
+
+        try:
+            result = query(flows, source)
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            computing.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._pending[key]
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        computing.set_result(result)
+        return result
+
+    def warm_up(self, flows, version, queries=STATE_QUERIES, workers=None):
+        """
+        Method that fills the cache with every query for every state, in a thread pool
+        :param flows: FlowTensor
+        :param version: data version of flows
+        :param queries: query functions to compute
+        :param workers: number of threads, defaults to the ThreadPoolExecutor default
+        """
+        jobs = [(query, source) for source in flows.states for query in queries]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda job: self.get(flows, version, *job), jobs))